@@ -1,14 +1,23 @@
+import csv
+import gzip
+import json
 import logging
+import queue
 import sys
-from typing import Iterator
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+from urllib.parse import unquote, urlparse
 
 import boto3
 import click
+from celery import group
 from dotenv import load_dotenv
-from sqlalchemy import URL, create_engine
+from sqlalchemy import URL, create_engine, select
+from sqlalchemy.orm import Session
 
-from models import Base
-from worker import transcode_video_task
+from models import Base, EncoderTask, Status
+from worker import S3_CLIENT_CONFIG, transcode_video_batch_task
 
 
 def configure_logging():
@@ -22,23 +31,115 @@ def configure_logging():
     )
 
 
-def iter_over_bucket(client, bucket) -> Iterator[str]:
-    args = {'Bucket': bucket, 'MaxKeys': 500}
-    logging.info('list s3 objects')
+def iter_pages(client, **args) -> Iterator[dict]:
     res = client.list_objects_v2(**args)
-    while res['KeyCount'] > 0:
-        logging.info(f'got {res["KeyCount"]} objects')
-        for content in res['Contents']:
-            yield content['Key']
-
-        token_args = {}
+    while True:
+        yield res
         if next_token := res.get('NextContinuationToken'):
-            token_args['ContinuationToken'] = next_token
-            res = client.list_objects_v2(**args, **token_args)
+            res = client.list_objects_v2(**args, ContinuationToken=next_token)
         else:
             break
 
 
+def iter_over_bucket(client, bucket, concurrency: int = 16) -> Iterator[str]:
+    """
+    Top level prefixes are listed concurrently, because a single
+    list_objects_v2 pagination is strictly sequential
+    """
+    args = {'Bucket': bucket, 'MaxKeys': 1000}
+    logging.info('list s3 objects')
+    prefixes = []
+    for res in iter_pages(client, **args, Delimiter='/'):
+        for content in res.get('Contents', []):
+            yield content['Key']
+        prefixes.extend(prefix['Prefix'] for prefix in res.get('CommonPrefixes', []))
+
+    if not prefixes:
+        return
+
+    logging.info('got %d prefixes', len(prefixes))
+    keys = queue.Queue(maxsize=10000)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                keys.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_prefix(prefix: str):
+        try:
+            for res in iter_pages(client, **args, Prefix=prefix):
+                logging.info('got %d objects from %s', res['KeyCount'], prefix)
+                for content in res.get('Contents', []):
+                    if not put(content['Key']):
+                        return
+        finally:
+            # sentinel: the prefix is done
+            put(None)
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(prefixes))) as pool:
+        futures = [pool.submit(list_prefix, prefix) for prefix in prefixes]
+        try:
+            finished = 0
+            while finished < len(futures):
+                key = keys.get()
+                if key is None:
+                    finished += 1
+                    continue
+                yield key
+        finally:
+            stopped.set()
+
+        for future in futures:
+            future.result()
+
+
+def iter_over_inventory(client, manifest_url: str) -> Iterator[str]:
+    """
+    Reads keys from an S3 Inventory report instead of listing the bucket.
+    manifest_url points to the manifest.json of a CSV report.
+    """
+    parsed_manifest_url = urlparse(manifest_url)
+    manifest = json.load(client.get_object(
+        Bucket=parsed_manifest_url.netloc,
+        Key=parsed_manifest_url.path.lstrip('/'),
+    )['Body'])
+    if manifest['fileFormat'] != 'CSV':
+        raise ValueError(f'Unsupported inventory format {manifest["fileFormat"]}')
+
+    key_column = [column.strip() for column in manifest['fileSchema'].split(',')].index('Key')
+    bucket = manifest['destinationBucket'].removeprefix('arn:aws:s3:::')
+    for file in manifest['files']:
+        logging.info('read inventory file %s', file['key'])
+        body = client.get_object(Bucket=bucket, Key=file['key'])['Body']
+        with gzip.open(body, mode='rt', newline='') as lines:
+            for row in csv.reader(lines):
+                # keys are URL-encoded in the report
+                yield unquote(row[key_column])
+
+
+def database_url(
+    database: str,
+    database_user: str,
+    database_password: str,
+    database_driver: str,
+    database_name: str,
+    database_port: int,
+) -> str:
+    return URL.create(
+        drivername=database_driver,
+        host=database,
+        username=database_user,
+        password=database_password,
+        database=database_name,
+        port=database_port,
+    ).render_as_string(hide_password=False)
+
+
 @click.command()
 @click.option(
     '--database', '-d',
@@ -83,14 +184,14 @@ def create_table(
     database_name: str,
     database_port: int,
 ):
-    url = URL.create(
-        drivername=database_driver,
-        host=database,
-        username=database_user,
-        password=database_password,
-        database=database_name,
-        port=database_port,
-    ).render_as_string(hide_password=False)
+    url = database_url(
+        database,
+        database_user,
+        database_password,
+        database_driver,
+        database_name,
+        database_port,
+    )
     print(url)
     engine = create_engine(url)
     Base.metadata.create_all(engine)
@@ -130,30 +231,120 @@ def create_table(
     required=True
 )
 @click.option('--input-bucket', type=click.STRING, required=True)
+@click.option(
+    '--inventory',
+    type=click.STRING,
+    required=False,
+    help='s3:// url of an S3 Inventory manifest.json used instead of listing the input bucket',
+)
+@click.option('--passthrough', is_flag=True, help='Also copy the source files to the output bucket')
+@click.option(
+    '--batch-size',
+    type=click.IntRange(min=1),
+    default=4,
+    help='Number of CRF/QP outputs encoded from a single decode',
+)
+@click.option(
+    '--database', '-d',
+    envvar='DATABASE_HOST',
+    type=click.STRING,
+    required=False,
+    help='Skip tasks which are already finished in this database',
+)
+@click.option(
+    '--database-user',
+    type=click.STRING,
+    envvar='DATABASE_USER',
+    required=False,
+)
+@click.option(
+    '--database-password',
+    type=click.STRING,
+    envvar='DATABASE_PASSWORD',
+    required=False,
+)
+@click.option(
+    '--database-driver',
+    envvar='DATABASE_DRIVER',
+    type=click.STRING,
+    default='sqlite',
+)
+@click.option(
+    '--database-name',
+    envvar='DATABASE_NAME',
+    type=click.STRING,
+)
+@click.option(
+    '--database-port',
+    envvar='DATABASE_PORT',
+    type=click.INT,
+    default=5432,
+)
 def generate_tasks(
     s3_access_key_id: str,
     s3_secret_access_key: str,
     input_bucket: str,
+    inventory: Optional[str],
     qp_min: int,
     qp_max: int,
     crf_min: int,
     crf_max: int,
+    passthrough: bool,
+    batch_size: int,
+    database: Optional[str],
+    database_user: str,
+    database_password: str,
+    database_driver: str,
+    database_name: str,
+    database_port: int,
 ):
     s3_client = boto3.client(
         's3',
         endpoint_url='https://storage.yandexcloud.net/',
         aws_access_key_id=s3_access_key_id,
         aws_secret_access_key=s3_secret_access_key,
+        config=S3_CLIENT_CONFIG,
     )
-    for path in iter_over_bucket(s3_client, input_bucket):
-        source_url = f's3://{input_bucket}/{path}'
-        prefix, _, filename = path.rpartition('/')
-        base_name, _, ext = path.rpartition('.')
-        for qp in range(qp_min, qp_max + 1):
-            transcode_video_task.delay(source_url=source_url, qp=qp)
+    finished = set()
+    if database:
+        engine = create_engine(database_url(
+            database,
+            database_user,
+            database_password,
+            database_driver,
+            database_name,
+            database_port,
+        ))
+        # One query instead of a lookup per task in the workers
+        with Session(engine) as session:
+            rows = session.execute(
+                select(EncoderTask.source_url, EncoderTask.crf, EncoderTask.qp).where(
+                    EncoderTask.status.in_([Status.SUCESS, Status.FAILED]),
+                )
+            )
+            finished = {tuple(row) for row in rows}
+        logging.info('%d tasks are already finished', len(finished))
 
-        for crf in range(crf_min, crf_max + 1):
-            transcode_video_task.delay(source_url=source_url, crf=crf)
+    if inventory:
+        paths = iter_over_inventory(s3_client, inventory)
+    else:
+        paths = iter_over_bucket(s3_client, input_bucket)
+
+    for path in paths:
+        source_url = f's3://{input_bucket}/{path}'
+        params = [
+            *((None, qp) for qp in range(qp_min, qp_max + 1)),
+            *((crf, None) for crf in range(crf_min, crf_max + 1)),
+            *([(None, None)] if passthrough else []),
+        ]
+        params = [(crf, qp) for crf, qp in params if (source_url, crf, qp) not in finished]
+        signatures = [
+            transcode_video_batch_task.s(source_url=source_url, params=params[i:i + batch_size])
+            for i in range(0, len(params), batch_size)
+        ]
+        if signatures:
+            # Publish all tasks of the file through one producer instead of a round-trip per task
+            group(signatures).apply_async()
 
 
 if __name__ == '__main__':
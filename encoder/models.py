@@ -1,7 +1,8 @@
+from datetime import datetime
 from enum import StrEnum
 from typing import Optional
 
-from sqlalchemy import Identity, String, Text
+from sqlalchemy import DateTime, Identity, Index, String, Text, func, literal_column
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 
@@ -30,3 +31,15 @@ class EncoderTask(Base):
     qp: Mapped[Optional[int]] = mapped_column(nullable=True)
     status: Mapped[Status] = mapped_column(nullable=True, default=Status.ENQUEUED)
     details: Mapped[str] = mapped_column(Text, nullable=True)
+    # Time of the last claim, IN_PROGRESS tasks are claimed again only after the lease expires
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+
+# crf or qp is always NULL, NULLs are distinct in a unique index, so they are coalesced
+UNIQUE_TASK_INDEX = Index(
+    'ux_encoder_tasks_source_url_crf_qp',
+    EncoderTask.source_url,
+    func.coalesce(EncoderTask.crf, literal_column('-1')),
+    func.coalesce(EncoderTask.qp, literal_column('-1')),
+    unique=True,
+)
@@ -1,20 +1,144 @@
+import hashlib
 import logging
 import os
 import shutil
 import subprocess
 import sys
-from functools import cached_property
-from tempfile import NamedTemporaryFile
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from contextlib import ExitStack, suppress
+from functools import cached_property, lru_cache
+from tempfile import NamedTemporaryFile, mkdtemp
 from typing import Optional
-from urllib.parse import urlparse
+from urllib.parse import ParseResult, urlparse
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from celery import Celery, Task
+from celery.signals import worker_process_shutdown
 from dotenv import load_dotenv
-from sqlalchemy import URL, create_engine
+from sqlalchemy import URL, create_engine, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import sessionmaker
 
-from models import EncoderTask, Status
+from models import UNIQUE_TASK_INDEX, EncoderTask, Status
+
+HW_ACCELERATORS = ('none', 'nvenc', 'vaapi', 'qsv')
+VAAPI_DEVICE = '/dev/dri/renderD128'
+GOP_SIZE = 240
+MIN_GOP_SIZE = 24
+# Constant parts of the ffmpeg command
+GLOBAL_PARAMS = ('-y', '-hide_banner', '-loglevel', 'error', '-fflags', '+genpts')
+OUTPUT_PARAMS = ('-fps_mode', 'passthrough', '-an', '-sn')
+NVENC_PARAMS = (
+    '-c:v', 'hevc_nvenc',
+    '-preset', 'p7',
+    '-tune', 'hq',
+    '-g', str(GOP_SIZE),
+    '-bf', '4',
+    '-rc-lookahead', '32',
+    '-spatial_aq', '1',
+    '-temporal_aq', '1',
+)
+LIBX265_PARAMS = (
+    '-c:v', 'libx265',
+    '-preset', 'veryslow',
+    '-pix_fmt', 'yuv420p',
+    '-g', str(GOP_SIZE),
+    '-keyint_min', str(MIN_GOP_SIZE),
+)
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    retries={
+        'mode': 'adaptive',
+        'max_attempts': 10,
+    },
+    tcp_keepalive=True,
+)
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 2 ** 20,
+    multipart_chunksize=8 * 2 ** 20,
+    max_concurrency=16,
+    use_threads=True,
+)
+DOWNLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 2 ** 20,
+    multipart_chunksize=16 * 2 ** 20,
+    max_concurrency=16,
+    use_threads=True,
+)
+COPY_TRANSFER_CONFIG = TransferConfig(
+    multipart_chunksize=16 * 2 ** 20,
+    max_concurrency=32,
+    use_threads=True,
+)
+# INSERT ... ON CONFLICT is dialect specific
+DIALECT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+@lru_cache(maxsize=None)
+def find_local_executable_path(executable_name: str) -> str:
+    possible_bin_dirs = [
+        f'./{executable_name}',
+        executable_name,
+    ]
+
+    for bin_ in possible_bin_dirs:
+        if resolved_binary := shutil.which(bin_):
+            return resolved_binary
+
+    raise FileNotFoundError(f"{executable_name} not found in PATH")
+
+
+class SourceCache:
+    """
+    Keeps the last downloaded source files on local storage.
+    Tasks of one file are enqueued together, so a worker usually
+    encodes the same source several times in a row.
+    Every cache has its own directory, prefork children do not evict each other's files.
+    """
+
+    def __init__(self, s3_client, directory: Optional[str], size: int):
+        self.s3_client = s3_client
+        self.directory = mkdtemp(prefix='sources-', dir=directory)
+        self.size = size
+        self.files: OrderedDict[str, str] = OrderedDict()
+
+    def get(self, parsed_source: ParseResult) -> str:
+        source_url = parsed_source.geturl()
+        if path := self.files.get(source_url):
+            if os.path.exists(path):
+                self.files.move_to_end(source_url)
+                return path
+            del self.files[source_url]
+
+        # free the space before the download
+        while self.files and len(self.files) >= self.size:
+            _, stale_path = self.files.popitem(last=False)
+            with suppress(FileNotFoundError):
+                os.remove(stale_path)
+
+        _, _, ext = parsed_source.path.rpartition('.')
+        digest = hashlib.sha256(source_url.encode()).hexdigest()
+        path = os.path.join(self.directory, f'{digest}.{ext}')
+        logging.info('Downloading %s to %s', source_url, path)
+        self.s3_client.download_file(
+            Bucket=parsed_source.netloc,
+            Key=parsed_source.path.lstrip('/'),
+            Filename=path,
+            Config=DOWNLOAD_TRANSFER_CONFIG,
+        )
+        self.files[source_url] = path
+        return path
+
+    def clear(self):
+        self.files.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
 
 
 class TranscodeVideoTask(Task):
@@ -42,138 +166,271 @@ class TranscodeVideoTask(Task):
         if not all([s3_access_key_id, s3_secret_access_key]):
             raise ValueError("S3 credentials not configured in worker")
 
-        return boto3.client(
+        # Own session per worker process, the default session is not safe to share
+        return boto3.session.Session().client(
             's3',
             endpoint_url=s3_endpoint_url,
             aws_access_key_id=s3_access_key_id,
             aws_secret_access_key=s3_secret_access_key,
+            config=S3_CLIENT_CONFIG,
         )
 
     @cached_property
     def ffmpeg_bin(self) -> Optional[str]:
-        executable_name = 'ffmpeg'
-        possible_bin_dirs = [
-            f'./{executable_name}',
-            executable_name,
-        ]
+        return find_local_executable_path('ffmpeg')
+
+    @cached_property
+    def hw_accel(self) -> str:
+        hw_accel = self.app.conf.get('hw_accel') or 'none'
+        if hw_accel not in HW_ACCELERATORS:
+            raise ValueError(f'Unknown hardware accelerator {hw_accel}')
 
-        for bin_ in possible_bin_dirs:
-            if resolved_binary := shutil.which(bin_):
-                return resolved_binary
+        if hw_accel == 'none':
+            return hw_accel
 
-        raise FileNotFoundError(f"{executable_name} not found in PATH")
+        encoders = subprocess.run(
+            [self.ffmpeg_bin, '-hide_banner', '-encoders'],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        if f'hevc_{hw_accel}' not in encoders:
+            logging.warning('hevc_%s is not supported by %s, fallback to libx265', hw_accel, self.ffmpeg_bin)
+            return 'none'
+
+        return hw_accel
 
     @property
     def output_bucket(self):
         return self.app.conf.get('s3_output_bucket')
 
+    @property
+    def tmp_dir(self) -> Optional[str]:
+        return self.app.conf.get('tmp_dir')
+
+    @cached_property
+    def source_cache(self) -> 'SourceCache':
+        return SourceCache(
+            self.s3_client,
+            self.tmp_dir,
+            int(self.app.conf.get('source_cache_size')),
+        )
+
+    def hw_accel_params(self) -> list[str]:
+        """Decoder params which must be placed before the input"""
+        match self.hw_accel:
+            case 'nvenc':
+                return ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda']
+            case 'vaapi':
+                return ['-vaapi_device', VAAPI_DEVICE]
+            case 'qsv':
+                return ['-hwaccel', 'qsv']
+            case _:
+                return []
+
+    @cached_property
+    def command_prefix(self) -> tuple[str, ...]:
+        """Part of the ffmpeg command before the input, it is the same for every call"""
+        return self.ffmpeg_bin, *GLOBAL_PARAMS, *self.hw_accel_params()
+
+    def codec_params(self, crf: Optional[int], qp: Optional[int], threads: Optional[int] = None) -> list[str]:
+        match self.hw_accel:
+            case 'nvenc':
+                params = [*NVENC_PARAMS]
+                if crf:
+                    # NVENC has no CRF, constant quality VBR is the closest mode
+                    params.extend(['-rc', 'vbr', '-cq', str(crf)])
+                else:
+                    params.extend(['-rc', 'constqp', '-qp', str(qp)])
+            case 'vaapi':
+                # VAAPI supports only constant QP, CRF value is used as QP
+                params = [
+                    '-vf', 'format=nv12,hwupload',
+                    '-c:v', 'hevc_vaapi',
+                    '-rc_mode', 'CQP',
+                    '-qp', str(crf or qp),
+                ]
+            case 'qsv':
+                params = ['-c:v', 'hevc_qsv', '-preset', 'veryslow']
+                if crf:
+                    params.extend(['-global_quality', str(crf)])
+                else:
+                    params.extend(['-q:v', str(qp)])
+            case _:
+                threads = threads or int(self.app.conf.get('thread_numbers'))
+                x265_params = ':'.join([
+                    'wpp=1',
+                    'pmode=1',
+                    'pme=1',
+                    f'frame-threads={max(1, threads // 4)}',
+                    f'pools={threads}',
+                ])
+                params = [
+                    *LIBX265_PARAMS,
+                    '-threads', str(threads),
+                    '-x265-params', x265_params,
+                ]
+                if crf:
+                    params.extend(['-crf', str(crf)])
+                else:
+                    params.extend(['-qp', str(qp)])
+
+        return params
+
     def encode_video(
         self,
         input_path: str,
-        output_path: str,
-        crf: Optional[int],
-        qp: Optional[int],
+        outputs: list[tuple[Optional[int], Optional[int], str]],
     ):
-        """Encode a video using ffmpeg with the given parameters."""
+        """
+        Encode a video using ffmpeg with the given parameters.
+        The source is decoded once for all the (crf, qp, output_path) outputs.
+        """
         try:
-            logging.info(f"Encoding video with CRF={crf}, QP={qp}")
-
-            # Build the ffmpeg command
-            input_params = [
-                '-seekable', '1',
-                '-reconnect_delay_max', '300',
-                '-multiple_requests', '1',
-                '-reconnect_on_http_error', '429,5xx',
-                '-reconnect_on_network_error', '1',
-                '-i', input_path,
-            ]
-            encode_params = [
-                '-c:v', 'libx265',
-                '-preset', 'veryslow',
-            ]
-            if crf:
-                encode_params.append('-crf')
-                encode_params.append(str(crf))
+            logging.info("Encoding video with CRF/QP=%s", [(crf, qp) for crf, qp, _ in outputs])
 
-            else:
-                encode_params.append('-qp')
-                encode_params.append(str(qp))
-            global_params = [
-                '-an',
-                '-sn',
-                '-y',
-                '-hide_banner',
-                '-loglevel', 'error',
-                output_path
-            ]
+            # x265 pools of the outputs share the same CPUs
+            threads = max(1, int(self.app.conf.get('thread_numbers')) // len(outputs))
+            # Build the ffmpeg command, only the codec params vary between calls
+            command = [*self.command_prefix, '-i', input_path]
+            for crf, qp, output_path in outputs:
+                command.extend(('-map', '0:v:0', *self.codec_params(crf, qp, threads), *OUTPUT_PARAMS, output_path))
 
             # Run the command
-            subprocess.run(
-                [
-                    self.ffmpeg_bin,
-                    *input_params,
-                    *encode_params,
-                    *global_params
-                ], check=True, capture_output=True, text=True
-            )
+            subprocess.run(command, check=True, capture_output=True, text=True)
         except subprocess.CalledProcessError as e:
-            logging.error(f"Error encoding video: {e.stderr}")
+            logging.error("Error encoding video: %s", e.stderr)
             raise RuntimeError(str(e)) from e
         except Exception as e:
-            logging.error(f"Unexpected error during encoding: {str(e)}")
+            logging.error("Unexpected error during encoding: %s", e)
             raise RuntimeError(f'Unknown error {e}') from e
 
-    def run(self, source_url: str, crf: Optional[int] = None, qp: Optional[int] = None):
-        with self.session_maker.begin() as session:
-            task = session.query(EncoderTask).filter_by(
-                source_url=source_url,
-                crf=crf,
-                qp=qp,
-            ).first()
-
-            if not task:
-                parsed_source_url = urlparse(source_url)
-                prefix, _, filename = parsed_source_url.path.lstrip('/').rpartition('/')
-                base_name, _, ext = filename.rpartition('.')
-                task = EncoderTask(
-                    source_url=source_url,
-                    status=Status.ENQUEUED,
-                )
-                if crf:
-                    task.crf = crf
-                    task.destination_url = f's3://{self.output_bucket}/{prefix}/{base_name}_crf_{crf}.{ext}'
-                else:
-                    task.qp = qp
-                    task.destination_url = f's3://{self.output_bucket}/{prefix}/{base_name}_qp_{qp}.{ext}'
-                session.add(task)
-
-            if task.status in (Status.SUCESS, Status.FAILED):
-                logging.error(f'Task {task.pk} is finished')
-                return
-
-            task.status = Status.IN_PROGRESS
-            session.commit()
-            task_id = task.pk
-            session.expunge(task)
-
-        parsed_source = urlparse(task.source_url)
-        presigned_url = self.s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': parsed_source.netloc, 'Key': parsed_source.path.lstrip('/')},
-            ExpiresIn=3600 * 24,
+    def copy_source(self, parsed_source: ParseResult, parsed_destination: ParseResult):
+        """Server-side copy, the data does not go through the worker"""
+        self.s3_client.copy(
+            CopySource={'Bucket': parsed_source.netloc, 'Key': parsed_source.path.lstrip('/')},
+            Bucket=parsed_destination.netloc,
+            Key=parsed_destination.path.lstrip('/'),
+            Config=COPY_TRANSFER_CONFIG,
         )
 
-        parsed_destination = urlparse(task.destination_url)
-
-        with NamedTemporaryFile(suffix='.mp4') as output_file:
-            logging.info(f'Encoding file {task.source_url}')
-            try:
-                self.encode_video(presigned_url, output_file.name, task.crf, task.qp)
+    def destination_exists(self, parsed_destination: ParseResult) -> bool:
+        try:
+            self.s3_client.head_object(
+                Bucket=parsed_destination.netloc,
+                Key=parsed_destination.path.lstrip('/'),
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != '404':
+                raise
+            return False
+        return True
+
+    def encode_and_upload(self, parsed_source: ParseResult, tasks: list[EncoderTask]):
+        input_path = self.source_cache.get(parsed_source)
+        with ExitStack() as stack:
+            output_files = [
+                stack.enter_context(NamedTemporaryFile(suffix='.mp4', dir=self.tmp_dir))
+                for _ in tasks
+            ]
+            self.encode_video(input_path, [
+                (task.crf, task.qp, output_file.name)
+                for task, output_file in zip(tasks, output_files)
+            ])
+            for task, output_file in zip(tasks, output_files):
+                parsed_destination = urlparse(task.destination_url)
                 self.s3_client.upload_file(
                     Filename=output_file.name,
                     Bucket=parsed_destination.netloc,
                     Key=parsed_destination.path.lstrip('/'),
+                    Config=UPLOAD_TRANSFER_CONFIG,
                 )
+
+    def destination_url(self, source_url: str, crf: Optional[int], qp: Optional[int]) -> str:
+        parsed_source_url = urlparse(source_url)
+        prefix, _, filename = parsed_source_url.path.lstrip('/').rpartition('/')
+        base_name, _, ext = filename.rpartition('.')
+        if crf:
+            return f's3://{self.output_bucket}/{prefix}/{base_name}_crf_{crf}.{ext}'
+        elif qp:
+            return f's3://{self.output_bucket}/{prefix}/{base_name}_qp_{qp}.{ext}'
+        # passthrough: the source is copied as is
+        return f's3://{self.output_bucket}/{prefix}/{filename}'
+
+    @property
+    def task_lease(self) -> timedelta:
+        return timedelta(seconds=int(self.app.conf.get('task_lease')))
+
+    def start_tasks(self, source_url: str, params: list[tuple[Optional[int], Optional[int]]]) -> list[EncoderTask]:
+        """
+        Creates or claims the tasks with a single upsert, finished tasks are not returned.
+        IN_PROGRESS tasks are claimed again only after the lease expires,
+        so a message redelivered after a crash (acks_late) resumes them,
+        while a duplicate delivery does not encode the same destination concurrently.
+        """
+        now = datetime.now(timezone.utc)
+        values = [
+            {
+                'source_url': source_url,
+                'crf': crf,
+                'qp': qp,
+                'destination_url': self.destination_url(source_url, crf, qp),
+                'status': Status.IN_PROGRESS,
+                'claimed_at': now,
+            }
+            for crf, qp in params
+        ]
+        with self.session_maker.begin() as session:
+            insert = DIALECT_INSERTS[session.bind.dialect.name]
+            statement = insert(EncoderTask).values(values).on_conflict_do_update(
+                index_elements=UNIQUE_TASK_INDEX.expressions,
+                set_={'status': Status.IN_PROGRESS, 'claimed_at': now},
+                # The conflicting row is locked, a concurrent upsert sees the new claim and skips it
+                where=EncoderTask.status.not_in([Status.SUCESS, Status.FAILED]) & or_(
+                    EncoderTask.status != Status.IN_PROGRESS,
+                    EncoderTask.claimed_at.is_(None),
+                    EncoderTask.claimed_at < now - self.task_lease,
+                ),
+            ).returning(EncoderTask)
+            started = list(session.scalars(statement))
+            session.commit()
+            for task in started:
+                session.expunge(task)
+
+        if len(started) < len(params):
+            logging.error(
+                '%d tasks of %s are finished or claimed by another worker',
+                len(params) - len(started),
+                source_url,
+            )
+        return started
+
+    def process(self, source_url: str, params: list[tuple[Optional[int], Optional[int]]]) -> list[dict]:
+        tasks = self.start_tasks(source_url, params)
+        if not tasks:
+            return []
+
+        # The output may be uploaded by a run which crashed before saving the status
+        pending = []
+        for task in tasks:
+            try:
+                exists = self.destination_exists(urlparse(task.destination_url))
+            except ClientError:
+                logging.exception('Failed checking %s', task.destination_url)
+                exists = False
+
+            if exists:
+                logging.info('%s already exists', task.destination_url)
+                task.status = Status.SUCESS
+            else:
+                pending.append(task)
+
+        parsed_source = urlparse(source_url)
+        copies = [task for task in pending if task.crf is None and task.qp is None]
+        encodes = [task for task in pending if task.crf is not None or task.qp is not None]
+
+        for task in copies:
+            try:
+                logging.info('Copying file %s', task.source_url)
+                self.copy_source(parsed_source, urlparse(task.destination_url))
             except Exception as e:
                 logging.exception('Failed processing task')
                 task.status = Status.FAILED
@@ -181,11 +438,39 @@ class TranscodeVideoTask(Task):
             else:
                 task.status = Status.SUCESS
 
+        if encodes:
+            try:
+                logging.info('Encoding file %s', source_url)
+                self.encode_and_upload(parsed_source, encodes)
+            except Exception as e:
+                logging.exception('Failed processing task')
+                for task in encodes:
+                    task.status = Status.FAILED
+                    task.details = str(e)
+            else:
+                for task in encodes:
+                    task.status = Status.SUCESS
+
+        # Bulk UPDATE by primary key, merge would SELECT every task first
         with self.session_maker.begin() as session:
-            session.merge(task)
-            session.commit()
+            session.execute(
+                update(EncoderTask),
+                [{'pk': task.pk, 'status': task.status, 'details': task.details} for task in tasks],
+            )
+
+        return [{'task_id': task.pk, 'status': task.status.value} for task in tasks]
+
+    def run(self, source_url: str, crf: Optional[int] = None, qp: Optional[int] = None):
+        if results := self.process(source_url, [(crf, qp)]):
+            return results[0]
 
-        return {'task_id': task_id, 'status': task.status.value}
+
+class TranscodeVideoBatchTask(TranscodeVideoTask):
+    """All the params of one source share a single decode"""
+    name = 'transcode_video_batch'
+
+    def run(self, source_url: str, params: list[tuple[Optional[int], Optional[int]]]):
+        return self.process(source_url, [(crf, qp) for crf, qp in params])
 
 
 def configure_logging():
@@ -211,6 +496,7 @@ def configure_celery():
         port=os.getenv('DATABASE_PORT'),
     ).render_as_string(hide_password=False)
     print(f'{result_backend=}')
+    worker_concurrency = int(os.getenv('WORKER_CONCURRENCY', 1))
     # Глобальные настройки, которые будут использоваться в Celery worker
     app.conf.update(
         broker_url=os.getenv('CELERY_BROKER_URL', 'redis://localhost/0'),
@@ -225,7 +511,20 @@ def configure_celery():
         database_password=os.getenv('DATABASE_PASSWORD'),
         database_name=os.getenv('DATABASE_NAME'),
         database_port=os.getenv('DATABASE_PORT'),
+        # none, nvenc, vaapi or qsv
+        hw_accel=os.getenv('HW_ACCEL', 'none'),
+        # Every prefork child runs its own encoder, the cores are split between them
+        thread_numbers=os.getenv('THREAD_COUNT', max(1, os.cpu_count() // worker_concurrency)),
+        # tmpfs keeps encoded files in RAM until they are uploaded
+        tmp_dir=os.getenv('TMP_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else None),
+        source_cache_size=os.getenv('SOURCE_CACHE_SIZE', 1),
+        # Seconds after which an IN_PROGRESS task is considered abandoned, longer than the slowest encode
+        task_lease=os.getenv('TASK_LEASE', 6 * 3600),
     )
+    # Every prefork child runs its own ffmpeg, long encodes must not be prefetched
+    app.conf.worker_concurrency = worker_concurrency
+    app.conf.worker_prefetch_multiplier = 1
+    app.conf.task_acks_late = True
     app.conf.broker_transport_options = {'is_secure': True}
 
     return app
@@ -235,3 +534,12 @@ load_dotenv()
 configure_logging()
 celery = configure_celery()
 transcode_video_task = celery.register_task(TranscodeVideoTask)
+transcode_video_batch_task = celery.register_task(TranscodeVideoBatchTask)
+
+
+@worker_process_shutdown.connect
+def clear_source_caches(**kwargs):
+    # The sources are kept in tmpfs, so they must not outlive the worker process
+    for task in (transcode_video_task, transcode_video_batch_task):
+        if 'source_cache' in task.__dict__:
+            task.source_cache.clear()
@@ -1,31 +1,34 @@
-import csv
 import io
 import logging
 import sys
-from collections import defaultdict
+import zlib
 from concurrent.futures import (
     FIRST_COMPLETED,
-    Future,
-    ProcessPoolExecutor,
     ThreadPoolExecutor,
     as_completed,
     wait,
 )
-from typing import Iterator
+from contextlib import closing
+from functools import partial
+from graphlib import TopologicalSorter
+from typing import BinaryIO, Callable, Iterator
 
 import boto3
 import click
 import numpy as np
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
-from decoder import Decoder
+from decoder import Decoder, iter_converted
 from extractors import (
     CIExtractor,
     Extractor,
     FHV13Extractor,
     FSI13Extractor,
     GLCMExtractor,
+    GLCMPropertiesExtractor,
     GLCMPropertyExtractor,
     SIExtractor,
     TICalculator,
@@ -33,15 +36,33 @@ from extractors import (
     VExtractor,
     YExtractor,
 )
+from extractors_numba import warmup
 from features import (
     FHV13Calculator,
     FeatureCalculator,
     MeanCalculator,
+    MeanStdCalculator,
     STDCalculator,
 )
+from prefetch import CONCURRENCY as PREFETCH_CONCURRENCY, PrefetchedObject
 
 Processor = Extractor | FeatureCalculator
 ProcessorResult = np.ndarray | float | None
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * 2 ** 20,
+    multipart_chunksize=16 * 2 ** 20,
+    max_concurrency=16,
+    use_threads=True,
+)
+# S3 allows parts from 5 MiB, the last one may be smaller
+CSV_PART_SIZE = 8 * 2 ** 20
+CSV_UPLOAD_CONCURRENCY = 4
+# Connections of one file in flight: the ranged GETs of the source and the CSV part uploads
+FILE_CONNECTIONS = PREFETCH_CONCURRENCY + CSV_UPLOAD_CONCURRENCY
+# The CSV is mostly digits and compresses well even by the fastest level
+CSV_GZIP_LEVEL = 1
+# Frames analyzed together, every extractor keeps its buffers for each of them
+BATCH_SIZE = 8
 
 
 def configure_logging():
@@ -55,21 +76,90 @@ def configure_logging():
     )
 
 
-def run_processor(processor: Processor, future: Future[np.ndarray]) -> tuple[Processor, ProcessorResult]:
+def batch_function(processor: Processor) -> Callable[[list[np.ndarray]], list[ProcessorResult]]:
+    """
+    Function processing a whole batch, it is selected once for the plan instead of every batch
+    """
     if isinstance(processor, Extractor):
-        return processor, processor.extract(future.result())
+        return processor.extract_batch
+
+    feed_frame = processor.feed_frame
+
+    def feed_batch(frames_data: list[np.ndarray]) -> list[ProcessorResult]:
+        return [feed_frame(frame_data) for frame_data in frames_data]
+
+    return feed_batch
+
+
+def format_field(value) -> str:
+    """
+    CSV field as csv.writer with QUOTE_STRINGS writes it: strings are quoted, None is empty
+    """
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_rows(columns: dict[str, list]) -> str:
+    """
+    Same output as csv.writer with QUOTE_STRINGS and '|' delimiter, without its per-row overhead
+    """
+    return ''.join(
+        '|'.join(row) + '\r\n'
+        for row in zip(*(map(format_field, column) for column in columns.values()))
+    )
 
-    return processor, processor.feed_frame(future.result())
 
+def fuse_moments(calculators: list[FeatureCalculator]) -> list[FeatureCalculator]:
+    """
+    Replaces MeanCalculator and STDCalculator of the same extractor by one MeanStdCalculator
+    """
+    means = {calc.extractor: calc for calc in calculators if type(calc) is MeanCalculator}
+    stds = {calc.extractor: calc for calc in calculators if type(calc) is STDCalculator}
+    fused = []
+    for calc in calculators:
+        if calc.depends_on() not in means or calc.depends_on() not in stds:
+            fused.append(calc)
+        elif type(calc) is MeanCalculator:
+            fused.append(MeanStdCalculator(calc.extractor, calc.name(), stds[calc.extractor].name()))
+    return fused
 
-def analyze_file(presigned_url) -> bytes:
+
+def execution_waves(processors: list[Processor]) -> list[list[Processor]]:
+    """
+    Groups the processors into waves, every processor depends only on the previous waves
+    """
+    processors_by_name = {processor.name(): processor for processor in processors}
+    sorter = TopologicalSorter({
+        processor.name(): [processor.depends_on()] if processor.depends_on() else []
+        for processor in processors
+    })
+    sorter.prepare()
+    waves = []
+    while sorter.is_active():
+        ready = sorter.get_ready()
+        waves.append([processors_by_name[name] for name in ready])
+        sorter.done(*ready)
+    return waves
+
+
+def iter_csv_chunks(source: str | BinaryIO) -> Iterator[bytes]:
+    """
+    CSV of the features is produced by batches, so it can be uploaded while the file is analyzed
+    """
     extractors = [
         YExtractor(),
         UExtractor(),
         VExtractor(),
-        SIExtractor(),
-        TICalculator(),
+        # Only the means and stds of SI and TI are computed, their planes are not needed
+        SIExtractor(moments_only=True),
+        TICalculator(moments_only=True),
         GLCMExtractor(),
+        GLCMPropertiesExtractor(),
         GLCMPropertyExtractor('correlation'),
         GLCMPropertyExtractor('contrast'),
         GLCMPropertyExtractor('energy'),
@@ -99,8 +189,6 @@ def analyze_file(presigned_url) -> bytes:
         MeanCalculator('CI_V'),
         FHV13Calculator(),
     ]
-    processors = extractors + feature_calculators
-    buffer = io.StringIO()
     fieldnames = [
         'width',
         'height',
@@ -113,71 +201,225 @@ def analyze_file(presigned_url) -> bytes:
     for calculator in feature_calculators:
         fieldnames.append(calculator.name())
 
-    writer = csv.DictWriter(buffer, fieldnames=fieldnames, quoting=csv.QUOTE_STRINGS, delimiter='|')
-    writer.writeheader()
-    with Decoder(presigned_url) as decoder:
+    # Values are accumulated by columns, the CSV is formatted once per batch
+    columns = {name: [] for name in fieldnames}
+    # Every batch overwrites all the results of the previous one
+    extractors_results = {}
+
+    def result_writer(processor: Processor) -> Callable[[list[ProcessorResult]], None]:
+        if isinstance(processor, Extractor):
+            return partial(extractors_results.__setitem__, processor.name())
+        if isinstance(processor, MeanStdCalculator):
+            mean_column, std_column = (columns[name] for name in processor.names())
+
+            def write_moments(result: list[tuple[float, float] | None]):
+                for values in result:
+                    mean, std = values or (None, None)
+                    mean_column.append(mean)
+                    std_column.append(std)
+
+            return write_moments
+        return columns[processor.name()].extend
+
+    def step(processor: Processor) -> tuple[Callable, str | None, Callable]:
+        return batch_function(processor), processor.depends_on(), result_writer(processor)
+
+    # Dependencies are the same for every frame, so the plan is computed once
+    waves = execution_waves(extractors + fuse_moments(feature_calculators))
+    # Only the heavy extractors go to the thread pool, views and feature reductions
+    # are cheaper than a submit, so they run in the decoding thread
+    plan = [
+        (
+            [step(processor) for processor in wave if isinstance(processor, Extractor) and processor.PARALLEL],
+            [step(processor) for processor in wave if not isinstance(processor, Extractor) or not processor.PARALLEL],
+        )
+        for wave in waves
+    ]
+
+    def analyze_batch(frames: list[np.ndarray]):
+        """Every processor is called once per batch, so the scheduling cost is shared by its frames"""
+        extractors_results[None] = frames
+        for pooled, inline in plan:
+            futures = [
+                (pool.submit(function, extractors_results[source]), write)
+                for function, source, write in pooled
+            ]
+            for function, source, write in inline:
+                write(function(extractors_results[source]))
+            for future, write in futures:
+                write(future.result())
+
+        chunk = format_rows(columns)
+        for column in columns.values():
+            column.clear()
+        return chunk.encode()
+
+    yield format_rows({name: [name] for name in fieldnames}).encode()
+    with Decoder(source) as decoder, closing(iter_converted(decoder)) as frames:
         with ThreadPoolExecutor() as pool:
-            for frame in decoder:
-                item = {
-                    'width': frame.width,
-                    'height': frame.height,
-                    'format': frame.format.name,
-                    'key_frame': int(frame.key_frame),
-                    'time': frame.time,
-                    'pts': frame.pts,
-                    'dts': frame.dts,
-                }
-                extractors_results = defaultdict(Future)
-                frame_data = frame.to_ndarray()
-                extractors_results[None].set_result(frame_data)
-                futures = []
-                for processor in processors:
-                    matrix_future = extractors_results[processor.depends_on()]
-                    futures.append(pool.submit(run_processor, processor, matrix_future))
-
-                for future in as_completed(futures):
-                    calc, result = future.result()
-                    if isinstance(calc, Extractor):
-                        extractors_results[calc.name()].set_result(result)
-                    else:
-                        item[calc.name()] = result
-                writer.writerow(item)
-    return buffer.getvalue().encode()
+            batch = []
+            for frame, frame_data in frames:
+                columns['width'].append(frame.width)
+                columns['height'].append(frame.height)
+                columns['format'].append(frame.format.name)
+                columns['key_frame'].append(int(frame.key_frame))
+                columns['time'].append(frame.time)
+                columns['pts'].append(frame.pts)
+                columns['dts'].append(frame.dts)
+                batch.append(frame_data)
+                if len(batch) == BATCH_SIZE:
+                    yield analyze_batch(batch)
+                    batch = []
+
+            if batch:
+                yield analyze_batch(batch)
+
+
+def analyze_file(source: str) -> bytes:
+    return b''.join(iter_csv_chunks(source))
+
+
+def iter_object_csv_chunks(s3_client, bucket: str, path: str) -> Iterator[bytes]:
+    """
+    The object is fetched by parallel ranged requests instead of a single HTTP stream,
+    the decoder reads the downloaded chunks while the next ones are being fetched
+    """
+    with PrefetchedObject(s3_client, bucket, path) as source:
+        yield from iter_csv_chunks(source)
+
+
+def gzip_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """
+    Compresses the chunks into a single gzip stream, chunks are yielded as soon as the compressor emits them
+    """
+    compressor = zlib.compressobj(CSV_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+
+def upload_csv(s3_client, bucket: str, key: str, chunks: Iterator[bytes], compress: bool = False) -> int:
+    """
+    Uploads the CSV by parts while the next chunks are produced,
+    a CSV smaller than one part is uploaded by a single request. Returns the uploaded size.
+    A compressed CSV is stored with Content-Encoding gzip under the same key.
+    """
+    extra_args = {}
+    if compress:
+        chunks = gzip_chunks(chunks)
+        extra_args['ContentEncoding'] = 'gzip'
+    chunks = iter(chunks)
+    part = bytearray()
+    for chunk in chunks:
+        part += chunk
+        if len(part) >= CSV_PART_SIZE:
+            break
+    else:
+        s3_client.upload_fileobj(
+            io.BytesIO(part),
+            Bucket=bucket,
+            Key=key,
+            ExtraArgs={'Metadata': {'Content-Type': 'text/csv'}, **extra_args},
+            Config=UPLOAD_TRANSFER_CONFIG,
+        )
+        return len(part)
+
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        Metadata={'Content-Type': 'text/csv'},
+        **extra_args,
+    )['UploadId']
+    size = 0
+    futures = []
+    outstanding = set()
+    try:
+        with ThreadPoolExecutor(max_workers=CSV_UPLOAD_CONCURRENCY) as pool:
+            while part:
+                size += len(part)
+                future = pool.submit(
+                    s3_client.upload_part,
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=len(futures) + 1,
+                    Body=bytes(part),
+                )
+                futures.append(future)
+                outstanding.add(future)
+                part = bytearray()
+                # Parts in memory are bounded, a failed upload stops the analysis early
+                if len(outstanding) >= CSV_UPLOAD_CONCURRENCY:
+                    done, outstanding = wait(outstanding, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                for chunk in chunks:
+                    part += chunk
+                    if len(part) >= CSV_PART_SIZE:
+                        break
+
+            parts = [
+                {'PartNumber': number, 'ETag': future.result()['ETag']}
+                for number, future in enumerate(futures, start=1)
+            ]
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts},
+        )
+    except BaseException:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    return size
+
+
+def create_s3_client(s3_access_key_id: str, s3_secret_access_key: str, max_pool_connections: int):
+    """
+    Client with enough connections for the parallel transfers, kept alive between the files
+    """
+    return boto3.client(
+        's3',
+        endpoint_url='https://storage.yandexcloud.net/',
+        aws_access_key_id=s3_access_key_id,
+        aws_secret_access_key=s3_secret_access_key,
+        config=Config(
+            max_pool_connections=max_pool_connections,
+            retries={
+                'mode': 'adaptive',
+                'max_attempts': 10,
+            },
+            tcp_keepalive=True,
+        ),
+    )
 
 
 class AnalyzeAndUploader:
-    def __init__(self, s3_access_key_id, s3_secret_access_key, input_bucket, output_bucket):
-        self.s3_access_key_id = s3_access_key_id
-        self.s3_secret_access_key = s3_secret_access_key
+    def __init__(self, s3_client, input_bucket, output_bucket, compress=False):
+        # boto3 clients are thread safe, all the files share one
+        self.s3_client = s3_client
         self.input_bucket = input_bucket
         self.output_bucket = output_bucket
+        self.compress = compress
 
     def __call__(self, path):
-        s3_client = boto3.client(
-            's3',
-            endpoint_url='https://storage.yandexcloud.net/',
-            aws_access_key_id=self.s3_access_key_id,
-            aws_secret_access_key=self.s3_secret_access_key,
-        )
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': self.input_bucket, 'Key': path},
-            ExpiresIn=3600 * 24,
-        )
-        logging.info(f'Analyzing file {self.input_bucket}/{path}')
+        s3_client = self.s3_client
+        logging.info('Analyzing file %s/%s', self.input_bucket, path)
         try:
-            csv_data = analyze_file(presigned_url)
+            size = upload_csv(
+                s3_client,
+                self.output_bucket,
+                f'{path}.csv',
+                iter_object_csv_chunks(s3_client, self.input_bucket, path),
+                self.compress,
+            )
         except Exception as e:
-            logging.exception(f'Error while analyzing file {self.input_bucket}/{path}: {e}')
+            logging.exception('Error while analyzing file %s/%s: %s', self.input_bucket, path, e)
             return
 
-        logging.info(f'Uploading {len(csv_data)} to {self.output_bucket}/{path}.csv')
-        s3_client.put_object(
-            Bucket=self.output_bucket,
-            Key=f'{path}.csv',
-            Body=csv_data,
-            Metadata={'Content-Type': 'text/csv'}
-        )
+        logging.info('Uploaded %d to %s/%s.csv', size, self.output_bucket, path)
 
 
 def iter_over_bucket(client, bucket) -> Iterator[str]:
@@ -185,7 +427,7 @@ def iter_over_bucket(client, bucket) -> Iterator[str]:
     logging.info('list s3 objects')
     res = client.list_objects_v2(**args)
     while res['KeyCount'] > 0:
-        logging.info(f'got {res["KeyCount"]} objects')
+        logging.info('got %d objects', res['KeyCount'])
         for content in res['Contents']:
             yield content['Key']
 
@@ -213,33 +455,25 @@ def iter_over_bucket(client, bucket) -> Iterator[str]:
 )
 @click.option('--input-bucket', type=click.STRING, required=True)
 @click.option('--output-bucket', type=click.STRING, required=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Upload the CSV with Content-Encoding gzip')
 def process_one(
     path: str,
     s3_access_key_id: str,
     s3_secret_access_key: str,
     input_bucket: str,
     output_bucket: str,
+    compress: bool,
 ):
-    s3_client = boto3.client(
-        's3',
-        endpoint_url='https://storage.yandexcloud.net/',
-        aws_access_key_id=s3_access_key_id,
-        aws_secret_access_key=s3_secret_access_key,
-    )
-    presigned_url = s3_client.generate_presigned_url(
-        'get_object',
-        Params={'Bucket': input_bucket, 'Key': path},
-        ExpiresIn=3600 * 24,
-    )
-    logging.info(f'Analyzing file {input_bucket}/{path}')
-    csv_data = analyze_file(presigned_url)
-    logging.info(f'Uploading {len(csv_data)} to {output_bucket}/{path}.csv')
-    s3_client.put_object(
-        Bucket=output_bucket,
-        Key=f'{path}.csv',
-        Body=csv_data,
-        Metadata={'Content-Type': 'text/csv'}
+    s3_client = create_s3_client(s3_access_key_id, s3_secret_access_key, FILE_CONNECTIONS)
+    logging.info('Analyzing file %s/%s', input_bucket, path)
+    size = upload_csv(
+        s3_client,
+        output_bucket,
+        f'{path}.csv',
+        iter_object_csv_chunks(s3_client, input_bucket, path),
+        compress,
     )
+    logging.info('Uploaded %d to %s/%s.csv', size, output_bucket, path)
 
 
 @click.command()
@@ -259,6 +493,7 @@ def process_one(
 @click.option('--output-bucket', type=click.STRING, required=True)
 @click.option('--concurrency', type=click.INT, default=1)
 @click.option('--rewrite', is_flag=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Upload the CSVs with Content-Encoding gzip')
 def process_bucket(
     s3_access_key_id: str,
     s3_secret_access_key: str,
@@ -266,14 +501,15 @@ def process_bucket(
     output_bucket: str,
     concurrency: int,
     rewrite: bool,
+    compress: bool,
 ):
-    s3_client = boto3.client(
-        's3',
-        endpoint_url='https://storage.yandexcloud.net/',
-        aws_access_key_id=s3_access_key_id,
-        aws_secret_access_key=s3_secret_access_key,
+    # One client is shared by the listing and all the file threads
+    s3_client = create_s3_client(
+        s3_access_key_id,
+        s3_secret_access_key,
+        concurrency * FILE_CONNECTIONS,
     )
-    logging.info(f'Collecting paths from {input_bucket}')
+    logging.info('Collecting paths from %s', input_bucket)
     paths = []
     for path in iter_over_bucket(s3_client, input_bucket):
         if rewrite:
@@ -290,17 +526,14 @@ def process_bucket(
             pass
         paths.append(path)
 
-    logging.info(f'Collected {len(paths)} paths')
+    logging.info('Collected %d paths', len(paths))
 
     in_queue_futures = set()
     done = set()
-    analyzer_and_uploader = AnalyzeAndUploader(
-        s3_access_key_id,
-        s3_secret_access_key,
-        input_bucket,
-        output_bucket,
-    )
-    with ProcessPoolExecutor(max_workers=concurrency, initializer=configure_logging) as pool:
+    # The heavy extractors release the GIL, so the files are analyzed by threads of one process
+    # which share the compiled kernels and the client
+    analyzer_and_uploader = AnalyzeAndUploader(s3_client, input_bucket, output_bucket, compress)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
         try:
             for path in paths:
                 future = pool.submit(analyzer_and_uploader, path)
@@ -319,5 +552,6 @@ def process_bucket(
 if __name__ == '__main__':
     load_dotenv()
     configure_logging()
+    warmup()
     cli = click.Group(commands=[process_one, process_bucket])
     cli()
@@ -1,6 +1,12 @@
+import queue
+import threading
 from typing import Self, Iterator
 
 import av
+import numpy as np
+
+# Frames converted ahead of the analysis
+PREFETCH_FRAMES = 8
 
 
 class Decoder:
@@ -28,3 +34,43 @@ class Decoder:
             for packet in self.container.demux(self.video_stream)
             for frame in packet.decode()
         )
+
+
+def iter_converted(decoder: Decoder, prefetch: int = PREFETCH_FRAMES) -> Iterator[tuple[av.VideoFrame, np.ndarray]]:
+    """
+    Frames with their ndarrays, decoding and to_ndarray run in a separate thread
+    ahead of the consumer. Must be closed before the decoder is.
+    """
+    frames = queue.Queue(maxsize=prefetch)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for frame in decoder:
+                if not put((frame, frame.to_ndarray())):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(end)
+
+    producer = threading.Thread(target=produce, name='decoder', daemon=True)
+    producer.start()
+    try:
+        while (item := frames.get()) is not end:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
@@ -3,10 +3,15 @@ from typing import Optional
 
 import numpy as np
 from scipy import ndimage
-from skimage.feature import graycomatrix, graycoprops
+from skimage.feature import graycoprops
+
+from extractors_numba import GLCM_PROPERTIES, diff_moments, glcm4, glcm_props_all, sobel_mag, sobel_moments
 
 
 class Extractor(ABC):
+    # Extractors which only take a view or select a row are cheaper than a thread pool submit
+    PARALLEL = True
+
     def depends_on(self) -> Optional[str]:
         return
 
@@ -18,11 +23,52 @@ class Extractor(ABC):
     def name(self) -> str:
         pass
 
+    def extract_batch(self, frames: list[Optional[np.ndarray]]) -> list[Optional[np.ndarray]]:
+        """
+        Extracts the frames of a batch in order, every frame position has its own buffers
+        """
+        results = []
+        for self.slot, frame in enumerate(frames):
+            results.append(self.extract(frame))
+        return results
+
+    def buffer(self, name: str, shape: tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        """
+        Array reused between batches, it is reallocated only when the frame size changes.
+        The result at the same position of the previous batch is overwritten,
+        so a batch must be consumed before the next one is extracted.
+        """
+        buffers = self.__dict__.setdefault('buffers', {})
+        key = name, self.__dict__.get('slot', 0)
+        buffer = buffers.get(key)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = buffers[key] = np.empty(shape, dtype=dtype)
+        return buffer
+
+
+class Moments:
+    """
+    Mean and std of a plane which is not materialized,
+    Mean and STD calculators read it the same way as an ndarray
+    """
+    __slots__ = ('mean_value', 'std_value')
+
+    def __init__(self, mean_value: float, std_value: float):
+        self.mean_value = mean_value
+        self.std_value = std_value
+
+    def mean(self) -> float:
+        return self.mean_value
+
+    def std(self) -> float:
+        return self.std_value
+
 
 class YExtractor(Extractor):
     """
     Takes only Y component
     """
+    PARALLEL = False
 
     def extract(self, frame: np.ndarray) -> np.ndarray:
         if frame.ndim == 3:
@@ -40,6 +86,7 @@ class UExtractor(Extractor):
     """
     Takes only U component
     """
+    PARALLEL = False
 
     def extract(self, frame: np.ndarray) -> np.ndarray:
         if frame.ndim == 3:
@@ -57,6 +104,7 @@ class VExtractor(Extractor):
     """
     Takes only V component
     """
+    PARALLEL = False
 
     def extract(self, frame: np.ndarray) -> np.ndarray:
         if frame.ndim == 3:
@@ -76,15 +124,20 @@ class SIExtractor(Extractor):
     https://www.itu.int/rec/T-REC-P.910-200804-I/en
     """
 
+    def __init__(self, moments_only: bool = False):
+        """
+        :param moments_only: the consumers need only mean and std of SI,
+            so the magnitude plane is not materialized and Moments are returned
+        """
+        self.moments_only = moments_only
+
     def depends_on(self) -> str:
         return 'Y'
 
-    def extract(self, frame: np.ndarray) -> np.ndarray:
-        frame = frame.astype(np.int16)
-        sob_x = ndimage.sobel(frame, axis=0)
-        sob_y = ndimage.sobel(frame, axis=1)
-
-        return np.hypot(sob_x, sob_y)
+    def extract(self, frame: np.ndarray) -> np.ndarray | Moments:
+        if self.moments_only:
+            return Moments(*sobel_moments(frame))
+        return sobel_mag(frame, self.buffer('si', frame.shape, np.float32))
 
     def name(self) -> str:
         return 'SI'
@@ -96,19 +149,33 @@ class TICalculator(Extractor):
     https://www.itu.int/rec/T-REC-P.910-200804-I/en
     """
 
-    def __init__(self):
+    def __init__(self, moments_only: bool = False):
+        """
+        :param moments_only: the consumers need only mean and std of TI,
+            so the difference is not materialized and Moments are returned
+        """
         self.prev_frame = None
+        self.moments_only = moments_only
 
     def depends_on(self) -> str:
         return 'Y'
 
-    def extract(self, frame: np.ndarray) -> Optional[np.ndarray]:
-        if self.prev_frame is None:
-            self.prev_frame = frame
-            return
-
-        ti = frame - self.prev_frame
-        self.prev_frame = frame
+    def extract(self, frame: np.ndarray) -> Optional[np.ndarray | Moments]:
+        ti = None
+        if self.prev_frame is not None and self.prev_frame.shape == frame.shape:
+            if self.moments_only and frame.dtype == np.uint8:
+                ti = Moments(*diff_moments(frame, self.prev_frame))
+            elif self.moments_only:
+                # diff_moments histograms 8-bit differences, deeper planes take the numpy path
+                diff = np.subtract(frame, self.prev_frame, out=self.buffer('ti', frame.shape, frame.dtype))
+                ti = Moments(diff.mean(), diff.std())
+            else:
+                # Overwritten by the next frame, consumers must read it before
+                ti = np.subtract(frame, self.prev_frame, out=self.buffer('ti', frame.shape, frame.dtype))
+
+        # Y is a view of the whole decoded frame, a copy does not keep the frame alive
+        self.prev_frame = self.buffer('prev_frame', frame.shape, frame.dtype)
+        np.copyto(self.prev_frame, frame)
         return ti
 
     def name(self) -> str:
@@ -117,33 +184,57 @@ class TICalculator(Extractor):
 
 class GLCMExtractor(Extractor):
     """
-    Gray level co-occurrence matrix
+    Gray level co-occurrence matrix, counts are not normalized:
+    graycoprops and glcm_props_all normalize them by themselves
     """
 
     def depends_on(self) -> str:
         return 'Y'
 
     def extract(self, frame: np.ndarray) -> np.ndarray:
-        return graycomatrix(
-            frame,
-            [1],
-            [0, np.pi / 4, np.pi / 2, 3 * np.pi / 4],
-            levels=256,
-            normed=True
-        )
+        if frame.dtype != np.uint8:
+            # glcm4 indexes the 256 levels by the pixel values
+            raise ValueError(f'GLCM requires an 8-bit plane, got {frame.dtype}')
+        counts = glcm4(frame, self.buffer('counts', (256, 256, 4), np.uint32))
+        # Same layout as graycomatrix(frame, [1], angles, levels=256)
+        return counts[:, :, np.newaxis, :]
 
     def name(self) -> str:
         return 'GLCM'
 
 
+class GLCMPropertiesExtractor(Extractor):
+    """
+    All the GLCM_PROPERTIES computed together, rows are properties and columns are angles
+    """
+
+    def depends_on(self) -> str:
+        return 'GLCM'
+
+    def extract(self, frame: np.ndarray) -> np.ndarray:
+        return glcm_props_all(frame, self.buffer('properties', (len(GLCM_PROPERTIES), frame.shape[3]), np.float64))
+
+    def name(self) -> str:
+        return 'GLCM_properties'
+
+
 class GLCMPropertyExtractor(Extractor):
+    """
+    Property of GLCM, the fused ones are taken from GLCMPropertiesExtractor
+    """
+    PARALLEL = False
+
     def __init__(self, property_name: str):
         self.property = property_name
 
     def depends_on(self) -> str:
+        if self.property in GLCM_PROPERTIES:
+            return 'GLCM_properties'
         return 'GLCM'
 
     def extract(self, frame: np.ndarray) -> np.ndarray:
+        if self.property in GLCM_PROPERTIES:
+            return frame[GLCM_PROPERTIES.index(self.property)]
         return graycoprops(frame, self.property)
 
     def name(self) -> str:
@@ -164,7 +255,8 @@ class CIExtractor(Extractor):
         return self.component
 
     def extract(self, frame: np.ndarray) -> Optional[np.ndarray]:
-        return frame * self.w_r
+        ci = self.buffer('ci', frame.shape, np.result_type(frame, self.w_r))
+        return np.multiply(frame, self.w_r, out=ci)
 
     def name(self) -> str:
         return f'CI_{self.component}'
@@ -214,9 +306,10 @@ class FSI13Extractor(Extractor):
         return 'FSI13'
 
     def extract(self, frame: np.ndarray) -> Optional[np.ndarray]:
-        gx = ndimage.convolve(frame, self.sobel_13_x, mode='reflect')
-        gy = ndimage.convolve(frame, self.sobel_13_y, mode='reflect')
-        return np.hypot(gx, gy)
+        gx = ndimage.convolve(frame, self.sobel_13_x, output=self.buffer('gx', frame.shape, frame.dtype), mode='reflect')
+        gy = ndimage.convolve(frame, self.sobel_13_y, output=self.buffer('gy', frame.shape, frame.dtype), mode='reflect')
+        # Same dtype as np.hypot gives for the integer planes
+        return np.hypot(gx, gy, out=self.buffer('r', frame.shape, np.promote_types(frame.dtype, np.float16)))
 
 
 class FHV13Extractor(Extractor):
@@ -266,11 +359,15 @@ class FHV13Extractor(Extractor):
         return 'FHV13_frames'
 
     def extract(self, frame: np.ndarray) -> Optional[np.ndarray]:
-        gx = ndimage.convolve(frame, self.sobel_13_x, mode='reflect')
-        gy = ndimage.convolve(frame, self.sobel_13_y, mode='reflect')
-        R = np.hypot(gx, gy)
-        theta = np.arctan2(gx, gy)
-        hv_mask = np.zeros_like(R)
+        gx = ndimage.convolve(frame, self.sobel_13_x, output=self.buffer('gx', frame.shape, frame.dtype), mode='reflect')
+        gy = ndimage.convolve(frame, self.sobel_13_y, output=self.buffer('gy', frame.shape, frame.dtype), mode='reflect')
+        dtype = np.promote_types(frame.dtype, np.float16)
+        R = np.hypot(gx, gy, out=self.buffer('r', frame.shape, dtype))
+        theta = np.arctan2(gx, gy, out=self.buffer('theta', frame.shape, dtype))
+        # Both masks are written into the result, the channels are filled in place instead of a dstack
+        masks = self.buffer('masks', (*frame.shape, 2), dtype)
+        masks.fill(0)
+        hv_mask = masks[:, :, 0]
         for m in range(4):
             # Угловой сектор для горизонтальных и вертикальных градиентов
             angle_center = m * np.pi / 2
@@ -280,7 +377,7 @@ class FHV13Extractor(Extractor):
             # Применяем маску для текущего квадранта
             mask_condition = (R >= self.R_MIN) & (theta > angle_min) & (theta < angle_max)
             hv_mask[mask_condition] = R[mask_condition]
-        not_hv_mask = np.zeros_like(R)
+        not_hv_mask = masks[:, :, 1]
         for m in range(4):
             # Угловой сектор для диагональных градиентов
             angle_center = m * np.pi / 2
@@ -291,4 +388,4 @@ class FHV13Extractor(Extractor):
             mask_condition = (R >= self.R_MIN) & (theta >= angle_min) & (theta <= angle_max)
             not_hv_mask[mask_condition] = R[mask_condition]
 
-        return np.dstack((hv_mask, not_hv_mask))
+        return masks
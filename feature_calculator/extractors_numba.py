@@ -0,0 +1,223 @@
+"""
+Numba kernels of the extractors.
+
+Extractors of one wave already run concurrently on the thread pool of calculate.py,
+so the kernels release the GIL instead of starting their own threads:
+the default numba threading layer can not be entered from several threads at once.
+"""
+import numpy as np
+from numba import njit
+
+
+@njit(nogil=True, cache=True)
+def sobel_at(y: np.ndarray, i: int, j: int) -> np.float32:
+    """
+    hypot(sobel(y, axis=0), sobel(y, axis=1)) at one pixel, borders are reflected as in scipy.ndimage
+    """
+    rows, cols = y.shape
+    top = max(i - 1, 0)
+    bottom = min(i + 1, rows - 1)
+    left = max(j - 1, 0)
+    right = min(j + 1, cols - 1)
+    gx = (
+        np.int32(y[bottom, left]) + 2 * np.int32(y[bottom, j]) + np.int32(y[bottom, right])
+        - np.int32(y[top, left]) - 2 * np.int32(y[top, j]) - np.int32(y[top, right])
+    )
+    gy = (
+        np.int32(y[top, right]) + 2 * np.int32(y[i, right]) + np.int32(y[bottom, right])
+        - np.int32(y[top, left]) - 2 * np.int32(y[i, left]) - np.int32(y[bottom, left])
+    )
+    return np.sqrt(np.float32(gx * gx + gy * gy))
+
+
+@njit(nogil=True, cache=True)
+def sobel_mag(y: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    Sobel magnitude of the whole plane in a single pass
+    """
+    rows, cols = y.shape
+    for i in range(rows):
+        for j in range(cols):
+            out[i, j] = sobel_at(y, i, j)
+    return out
+
+
+@njit(nogil=True, cache=True)
+def sobel_moments(y: np.ndarray) -> tuple[float, float]:
+    """
+    Mean and std of the Sobel magnitude without materializing it,
+    the same sums as mean_std of the sobel_mag output
+    """
+    rows, cols = y.shape
+    count = rows * cols
+    if count == 0:
+        return np.nan, np.nan
+
+    shift = np.float64(sobel_at(y, 0, 0))
+    total = 0.0
+    total_squares = 0.0
+    for i in range(rows):
+        for j in range(cols):
+            value = np.float64(sobel_at(y, i, j)) - shift
+            total += value
+            total_squares += value * value
+    mean = total / count
+    variance = max(total_squares / count - mean * mean, 0.0)
+    return shift + mean, np.sqrt(variance)
+
+
+@njit(nogil=True, cache=True)
+def diff_moments(cur: np.ndarray, prev: np.ndarray) -> tuple[float, float]:
+    """
+    Mean and std of the uint8 difference cur - prev (wrapping like numpy) without materializing it.
+    A histogram of the 256 possible values is accumulated in one pass, the moments are taken from it.
+    """
+    histogram = np.zeros(256, dtype=np.int64)
+    rows, cols = cur.shape
+    for i in range(rows):
+        for j in range(cols):
+            histogram[(np.int32(cur[i, j]) - np.int32(prev[i, j])) & 0xFF] += 1
+
+    total = 0
+    for value in range(256):
+        total += value * histogram[value]
+    count = rows * cols
+    mean = total / count
+
+    variance = 0.0
+    for value in range(256):
+        variance += histogram[value] * (value - mean) ** 2
+    return mean, np.sqrt(variance / count)
+
+
+@njit(nogil=True, cache=True)
+def glcm4(y: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    Co-occurrence counts of the 8-bit plane at distance 1 for the angles 0, pi/4, pi/2, 3pi/4,
+    out shape is (256, 256, 4). Offsets are (0, 1), (1, 1), (1, 0), (1, -1) as skimage rounds them.
+    """
+    rows, cols = y.shape
+    out[:] = 0
+    for i in range(rows):
+        has_next_row = i + 1 < rows
+        for j in range(cols):
+            value = y[i, j]
+            if j + 1 < cols:
+                out[value, y[i, j + 1], 0] += 1
+            if has_next_row:
+                if j + 1 < cols:
+                    out[value, y[i + 1, j + 1], 1] += 1
+                out[value, y[i + 1, j], 2] += 1
+                if j > 0:
+                    out[value, y[i + 1, j - 1], 3] += 1
+    return out
+
+
+# Rows of the glcm_props_all result
+GLCM_PROPERTIES = ('contrast', 'correlation', 'energy', 'homogeneity')
+
+
+@njit(nogil=True, cache=True)
+def glcm_props_all(glcm: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    graycoprops contrast, correlation, energy and homogeneity of a (256, 256, 1, angles) GLCM of counts,
+    out shape is (4, angles) in the GLCM_PROPERTIES order.
+    Counts are normalized on the fly like graycoprops does, the normalized matrix is never stored.
+    The matrix is read once for the total, once for the marginals and the weighted sums,
+    and once more for the covariance.
+    """
+    levels = glcm.shape[0]
+    marginal_i = np.empty(levels)
+    marginal_j = np.empty(levels)
+    for angle in range(glcm.shape[3]):
+        total = 0
+        for i in range(levels):
+            for j in range(levels):
+                total += glcm[i, j, 0, angle]
+        total = max(total, 1)
+
+        contrast = 0.0
+        asm = 0.0
+        homogeneity = 0.0
+        marginal_i[:] = 0
+        marginal_j[:] = 0
+        for i in range(levels):
+            for j in range(levels):
+                if glcm[i, j, 0, angle] == 0:
+                    continue
+                p = glcm[i, j, 0, angle] / total
+                diff = (i - j) ** 2
+                contrast += diff * p
+                asm += p * p
+                homogeneity += p / (1 + diff)
+                marginal_i[i] += p
+                marginal_j[j] += p
+
+        mean_i = 0.0
+        mean_j = 0.0
+        for level in range(levels):
+            mean_i += level * marginal_i[level]
+            mean_j += level * marginal_j[level]
+        var_i = 0.0
+        var_j = 0.0
+        for level in range(levels):
+            var_i += marginal_i[level] * (level - mean_i) ** 2
+            var_j += marginal_j[level] * (level - mean_j) ** 2
+        std_i = np.sqrt(var_i)
+        std_j = np.sqrt(var_j)
+
+        if std_i < 1e-15 or std_j < 1e-15:
+            correlation = 1.0
+        else:
+            covariance = 0.0
+            for i in range(levels):
+                for j in range(levels):
+                    if glcm[i, j, 0, angle] != 0:
+                        covariance += glcm[i, j, 0, angle] / total * (i - mean_i) * (j - mean_j)
+            correlation = covariance / (std_i * std_j)
+
+        out[0, angle] = contrast
+        out[1, angle] = correlation
+        out[2, angle] = np.sqrt(asm)
+        out[3, angle] = homogeneity
+    return out
+
+
+@njit(nogil=True, cache=True)
+def mean_std(a: np.ndarray) -> tuple[float, float]:
+    """
+    Mean and std of a 2d array in a single pass, the sums are accumulated in float64.
+    Values are shifted by the first one, so the sum of squares does not lose the precision.
+    """
+    rows, cols = a.shape
+    count = rows * cols
+    if count == 0:
+        return np.nan, np.nan
+
+    shift = np.float64(a[0, 0])
+    total = 0.0
+    total_squares = 0.0
+    for i in range(rows):
+        for j in range(cols):
+            value = np.float64(a[i, j]) - shift
+            total += value
+            total_squares += value * value
+    mean = total / count
+    variance = max(total_squares / count - mean * mean, 0.0)
+    return shift + mean, np.sqrt(variance)
+
+
+def warmup():
+    """
+    Loads the kernels from the disk cache (or compiles them) with the argument types of the extractors,
+    so the first frames do not wait for the compilation
+    """
+    y = np.zeros((4, 4), dtype=np.uint8)
+    si = sobel_mag(y, np.empty(y.shape, dtype=np.float32))
+    sobel_moments(y)
+    diff_moments(y, y)
+    counts = glcm4(y, np.empty((256, 256, 4), dtype=np.uint32))
+    properties = glcm_props_all(counts[:, :, np.newaxis, :], np.empty((len(GLCM_PROPERTIES), 4)))
+    mean_std(y)
+    mean_std(si)
+    mean_std(np.atleast_2d(properties[0]))
@@ -3,6 +3,8 @@ from typing import Optional
 
 import numpy as np
 
+from extractors_numba import mean_std
+
 
 class FeatureCalculator(ABC):
     def depends_on(self) -> Optional[str]:
@@ -49,6 +51,37 @@ class MeanCalculator(FeatureCalculator):
         return self._name or f'{self.extractor}_mean'
 
 
+class MeanStdCalculator(FeatureCalculator):
+    """
+    MeanCalculator and STDCalculator of the same extractor fused,
+    the frame is read once and both values are returned
+    """
+
+    def __init__(self, extractor: str, mean_name: str = None, std_name: str = None):
+        self.extractor = extractor
+        self.mean_name = mean_name or f'{extractor}_mean'
+        self.std_name = std_name or f'{extractor}_std'
+
+    def depends_on(self) -> str:
+        return self.extractor
+
+    def feed_frame(self, frame: Optional[np.ndarray]) -> Optional[tuple[float, float]]:
+        if frame is None:
+            return
+        if not isinstance(frame, np.ndarray):
+            # Moments of a plane which is not materialized
+            return float(frame.mean()), float(frame.std())
+
+        mean, std = mean_std(np.atleast_2d(frame))
+        return float(mean), float(std)
+
+    def names(self) -> tuple[str, str]:
+        return self.mean_name, self.std_name
+
+    def name(self) -> str:
+        return f'{self.extractor}_mean_std'
+
+
 class FHV13Calculator(FeatureCalculator):
     def depends_on(self) -> Optional[str]:
         return 'FHV13_frames'
@@ -0,0 +1,96 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryFile
+
+CHUNK_SIZE = 8 * 2 ** 20
+CONCURRENCY = 8
+
+
+class PrefetchedObject(io.RawIOBase):
+    """
+    S3 object downloaded by parallel ranged GETs into a temporary file.
+    Reads block only until their chunk is downloaded, so the decoder starts
+    on the first chunks while the rest of the object is still being fetched.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.position = 0
+        self.file = TemporaryFile()
+        self.file.truncate(self.size)
+        self.chunks_count = max(1, -(-self.size // CHUNK_SIZE))
+        self.downloaded = [False] * self.chunks_count
+        self.error: Exception | None = None
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=CONCURRENCY)
+        # mp4 index is often at the end of the file, the demuxer reads it before the frames
+        order = [self.chunks_count - 1, *range(self.chunks_count - 1)]
+        for index in order:
+            self.pool.submit(self._download, index)
+
+    def _download(self, index: int):
+        start = index * CHUNK_SIZE
+        end = min(self.size, start + CHUNK_SIZE) - 1
+        try:
+            if start <= end:
+                response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={start}-{end}')
+                os.pwrite(self.file.fileno(), response['Body'].read(), start)
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+            return
+
+        with self.condition:
+            self.downloaded[index] = True
+            self.condition.notify_all()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f'Unknown whence {whence}')
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.size:
+            return 0
+
+        index = self.position // CHUNK_SIZE
+        # A short read up to the end of the chunk, the next one may still be downloading
+        length = min(len(buffer), (index + 1) * CHUNK_SIZE - self.position, self.size - self.position)
+        with self.condition:
+            while not self.downloaded[index]:
+                if self.error is not None:
+                    raise self.error
+                self.condition.wait()
+
+        data = os.pread(self.file.fileno(), length, self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.file.close()
+        super().close()
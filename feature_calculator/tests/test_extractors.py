@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from extractors import GLCMExtractor, TICalculator
+
+
+def test_glcm_rejects_deep_planes():
+    frame = np.full((4, 4), 1023, dtype=np.uint16)
+    with pytest.raises(ValueError):
+        GLCMExtractor().extract(frame)
+
+
+def test_ti_moments_of_deep_planes():
+    prev = np.zeros((4, 4), dtype=np.uint16)
+    frame = np.full((4, 4), 700, dtype=np.uint16)
+    frame[0] = 0
+    calculator = TICalculator(moments_only=True)
+    calculator.extract(prev)
+    ti = calculator.extract(frame)
+    expected = np.subtract(frame, prev)
+    assert ti.mean() == pytest.approx(expected.mean())
+    assert ti.std() == pytest.approx(expected.std())
@@ -1,16 +1,19 @@
 import logging
 import sys
-from concurrent.futures.thread import ThreadPoolExecutor
+from itertools import batched
 
 import click
+from celery import group
 from dotenv import load_dotenv
-from sqlalchemy import URL, create_engine
+from sqlalchemy import URL, create_engine, func, select
 from sqlalchemy.orm import Session
 from tqdm import tqdm
 
 from models import EncoderTask, Status
 from worker import quality_analyze_task
 
+PUBLISH_BATCH_SIZE = 1000
+
 
 def configure_logging():
     handler = logging.StreamHandler(stream=sys.stdout)
@@ -77,17 +80,21 @@ def generate_tasks(
     ).render_as_string(hide_password=False)
     engine = create_engine(url)
     with Session(engine) as session:
-        with ThreadPoolExecutor() as pool:
-            total = session.query(EncoderTask).filter_by(status=Status.SUCESS).count()
-            cursor = session.query(EncoderTask).filter_by(
-                status=Status.SUCESS,
-            )
-            futures = pool.map(
-                lambda task: quality_analyze_task.delay(task.source_url, task.destination_url),
-                cursor
-            )
-            for _ in tqdm(futures, total=total):
-                pass
+        total = session.scalar(select(func.count()).where(EncoderTask.status == Status.SUCESS))
+        # Rows are streamed by a server side cursor instead of being loaded at once
+        rows = session.execute(
+            select(EncoderTask.source_url, EncoderTask.destination_url)
+            .where(EncoderTask.status == Status.SUCESS)
+            .execution_options(stream_results=True, yield_per=PUBLISH_BATCH_SIZE)
+        )
+        with tqdm(total=total) as progress:
+            for batch in batched(rows, PUBLISH_BATCH_SIZE):
+                # Tasks of a batch are published through one producer instead of a round-trip per task
+                group(
+                    quality_analyze_task.s(source_url, destination_url)
+                    for source_url, destination_url in batch
+                ).apply_async()
+                progress.update(len(batch))
 
 
 if __name__ == '__main__':
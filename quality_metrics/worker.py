@@ -9,11 +9,19 @@ from typing import Optional
 from urllib.parse import urlparse
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from celery import Celery, Task
 from dotenv import load_dotenv
 from sqlalchemy import URL
 
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 2 ** 20,
+    multipart_chunksize=8 * 2 ** 20,
+    max_concurrency=8,
+    use_threads=True,
+)
+
 
 class QualityAnalyzeTask(Task):
     name = 'quality_analyze'
@@ -52,57 +60,59 @@ class QualityAnalyzeTask(Task):
 
         raise FileNotFoundError(f"{executable_name} not found in PATH")
 
-    def analyze_file(self, source_url, distorted_url) -> bytes:
-        with NamedTemporaryFile(suffix='.csv') as output_file:
-            try:
-                # Build the ffmpeg command
-                input_params = [
-                    '-seekable', '1',
-                    '-reconnect_delay_max', '300',
-                    '-multiple_requests', '1',
-                    '-reconnect_on_http_error', '429,5xx',
-                    '-reconnect_on_network_error', '1',
-                    '-i', distorted_url,
-                    '-seekable', '1',
-                    '-reconnect_delay_max', '300',
-                    '-multiple_requests', '1',
-                    '-reconnect_on_http_error', '429,5xx',
-                    '-reconnect_on_network_error', '1',
-                    '-i', source_url,
-                ]
-                filter_params = [
-                    '-lavfi', "libvmaf='"
-                              r"model=version=vmaf_v0.6.1neg\:name=vmaf_neg"
-                              f":n_threads={self.app.conf.get('thread_numbers')}"
-                              ":log_fmt=csv"
-                              f":log_path={output_file.name}'"
-                ]
-                global_params = [
-                    '-f',
-                    'null',
-                    '-y',
-                    '-hide_banner',
-                    '-loglevel', 'error',
-                    '-'
-                ]
-
-                # Run the command
-                subprocess.run(
-                    [
-                        self.ffmpeg_bin,
-                        *input_params,
-                        *filter_params,
-                        *global_params
-                    ], check=True, capture_output=True, text=True
-                )
-            except subprocess.CalledProcessError as e:
-                logging.error(f"Error encoding video: {e.stderr}")
-                raise RuntimeError(str(e)) from e
-            except Exception as e:
-                logging.error(f"Unexpected error during encoding: {str(e)}")
-                raise RuntimeError(f'Unknown error {e}') from e
-            output_file.seek(0)
-            return output_file.read()
+    def analyze_file(self, source_url, distorted_url, log_path: str):
+        """
+        libvmaf writes the CSV log when all the frames are compared, the log stays on disk
+        """
+        try:
+            # Build the ffmpeg command
+            input_params = [
+                '-seekable', '1',
+                '-reconnect_delay_max', '300',
+                '-multiple_requests', '1',
+                '-reconnect_on_http_error', '429,5xx',
+                '-reconnect_on_network_error', '1',
+                '-i', distorted_url,
+                '-seekable', '1',
+                '-reconnect_delay_max', '300',
+                '-multiple_requests', '1',
+                '-reconnect_on_http_error', '429,5xx',
+                '-reconnect_on_network_error', '1',
+                '-i', source_url,
+            ]
+            filter_params = [
+                '-lavfi', "libvmaf='"
+                          r"model=version=vmaf_v0.6.1neg\:name=vmaf_neg"
+                          # MS-SSIM is computed by the native libvmaf extractor in the same pass
+                          ":feature=name=float_ms_ssim"
+                          f":n_threads={self.app.conf.get('thread_numbers')}"
+                          ":log_fmt=csv"
+                          f":log_path={log_path}'"
+            ]
+            global_params = [
+                '-f',
+                'null',
+                '-y',
+                '-hide_banner',
+                '-loglevel', 'error',
+                '-'
+            ]
+
+            # Run the command
+            subprocess.run(
+                [
+                    self.ffmpeg_bin,
+                    *input_params,
+                    *filter_params,
+                    *global_params
+                ], check=True, capture_output=True, text=True
+            )
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Error encoding video: {e.stderr}")
+            raise RuntimeError(str(e)) from e
+        except Exception as e:
+            logging.error(f"Unexpected error during encoding: {str(e)}")
+            raise RuntimeError(f'Unknown error {e}') from e
 
     def run(self, source_url: str, distorted_url: str):
         parsed_source = urlparse(source_url)
@@ -129,16 +139,19 @@ class QualityAnalyzeTask(Task):
             ExpiresIn=3600 * 24,
         )
         logging.info(f'Analyzing file {distorted_url}')
-        csv_data = self.analyze_file(presigned_source_url, presigned_distorted_url)
-        logging.info(
-            f'Uploading {len(csv_data)} to {self.output_bucket}/{new_path}'
-        )
-        self.s3_client.put_object(
-            Bucket=self.output_bucket,
-            Key=new_path,
-            Body=csv_data,
-            Metadata={'Content-Type': 'text/csv'},
-        )
+        with NamedTemporaryFile(suffix='.csv') as output_file:
+            self.analyze_file(presigned_source_url, presigned_distorted_url, output_file.name)
+            logging.info(
+                f'Uploading {os.path.getsize(output_file.name)} to {self.output_bucket}/{new_path}'
+            )
+            # The log is uploaded from the disk by parallel parts instead of being read into memory
+            self.s3_client.upload_file(
+                Filename=output_file.name,
+                Bucket=self.output_bucket,
+                Key=new_path,
+                ExtraArgs={'Metadata': {'Content-Type': 'text/csv'}},
+                Config=UPLOAD_TRANSFER_CONFIG,
+            )
 
 
 def configure_logging():
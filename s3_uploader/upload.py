@@ -1,18 +1,26 @@
 import logging
 import sqlite3
 import sys
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
 from concurrent.futures.thread import ThreadPoolExecutor
-from tempfile import NamedTemporaryFile
+from typing import Iterator
 
 import boto3
 import click
-from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
-from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 from requests import Session
 from requests.adapters import HTTPAdapter, Retry
 
+# A Python iteration per MiB instead of per 8 KiB of the video, parts are whole chunks
+DOWNLOAD_CHUNK_SIZE = 2 ** 20
+# S3 allows parts from 5 MiB, the last one may be smaller
+PART_SIZE = 8 * 2 ** 20
+PART_UPLOAD_CONCURRENCY = 4
+# Progress rows committed together, an interrupted run leaves at most this many rows with
+# success IS NULL, the next run skips their already uploaded files through existing_keys
+PROGRESS_COMMIT_SIZE = 50
+
 
 class Copier:
     default_s3_client_config = Config(
@@ -21,7 +29,8 @@ class Copier:
         retries={
             'mode': 'standard',
             'max_attempts': 192,
-        }
+        },
+        tcp_keepalive=True,
     )
 
     def __init__(
@@ -32,8 +41,10 @@ class Copier:
         concurrency
     ):
         self.http_client = self._create_session(concurrency)
+        # The client is thread safe and shared by all the copying threads,
+        # every thread uploads its parts and makes one more request at a time
         s3_client_config = self.default_s3_client_config.merge(
-            Config(max_pool_connections=concurrency * 10),
+            Config(max_pool_connections=concurrency * (PART_UPLOAD_CONCURRENCY + 1)),
         )
         self.s3_client = boto3.client(
             's3',
@@ -44,12 +55,7 @@ class Copier:
         )
         self.bucket = bucket
         self.logger = logging.getLogger('Copier')
-        self.transfer_config = TransferConfig(
-            multipart_threshold=5 * 2 ** 30,
-            max_concurrency=concurrency * 10,
-            multipart_chunksize=8 * 2 ** 20,
-            use_threads=True,
-        )
+        self.existing_keys: set[str] = set()
 
     @staticmethod
     def _create_session(concurrency):
@@ -60,6 +66,8 @@ class Copier:
             backoff_factor=0.1
         )
         session = Session()
+        # Videos are already compressed, a Content-Encoding would only cost a decompression per chunk
+        session.headers['Accept-Encoding'] = 'identity'
         adapter = HTTPAdapter(
             max_retries=retry_strategy,
             pool_maxsize=concurrency,
@@ -70,39 +78,88 @@ class Copier:
         session.mount('https://', adapter)
         return session
 
+    def collect_existing_keys(self):
+        """
+        Keys of the bucket listed by pages of 1000 instead of a HEAD request per file
+        """
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket):
+            self.existing_keys.update(content['Key'] for content in page.get('Contents', []))
+        self.logger.info('%d files are already uploaded', len(self.existing_keys))
+
     def copy_file_to_s3(self, src_url, dst_path):
         self.logger.info(f'Downloading from {src_url} to {dst_path}')
-        try:
-            self.s3_client.head_object(
-                Bucket=self.bucket,
-                Key=dst_path,
-            )
+        if dst_path in self.existing_keys:
             return
-        except ClientError:
-            pass
 
         with self.http_client.get(src_url, stream=True) as response:
             response.raise_for_status()
-            tmp_context = NamedTemporaryFile(
-                buffering=10 * 2 ** 20,
-                suffix='.mkv',
-                prefix=dst_path.rpartition('/')[-1]
+            self.upload_stream(
+                response.iter_content(DOWNLOAD_CHUNK_SIZE),
+                dst_path,
+                response.headers['Content-Type'],
             )
-            with tmp_context as tempfile:
-                for chunk in response.iter_content(8192):
-                    tempfile.write(chunk)
-
-                tempfile.flush()
-                tempfile.seek(0)
-                self.s3_client.upload_fileobj(
-                    tempfile,
-                    Bucket=self.bucket,
-                    Key=dst_path,
-                    ExtraArgs={"ContentType": response.headers['Content-Type']},
-                    Config=self.transfer_config
-                )
         self.logger.info(f'Finished uploading {src_url}')
 
+    def upload_stream(self, chunks: Iterator[bytes], dst_path: str, content_type: str):
+        """
+        Uploads the downloaded chunks by parts while the next ones are downloaded,
+        nothing is spooled to the disk. A file smaller than one part is uploaded by a single request.
+        """
+        part = bytearray()
+        for chunk in chunks:
+            part += chunk
+            if len(part) >= PART_SIZE:
+                break
+        else:
+            self.s3_client.put_object(Bucket=self.bucket, Key=dst_path, Body=bytes(part), ContentType=content_type)
+            return
+
+        upload_id = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket,
+            Key=dst_path,
+            ContentType=content_type,
+        )['UploadId']
+        futures = []
+        outstanding = set()
+        try:
+            with ThreadPoolExecutor(max_workers=PART_UPLOAD_CONCURRENCY) as pool:
+                while part:
+                    future = pool.submit(
+                        self.s3_client.upload_part,
+                        Bucket=self.bucket,
+                        Key=dst_path,
+                        UploadId=upload_id,
+                        PartNumber=len(futures) + 1,
+                        Body=bytes(part),
+                    )
+                    futures.append(future)
+                    outstanding.add(future)
+                    part = bytearray()
+                    # Parts in memory are bounded, the download waits for the slowest uploads
+                    if len(outstanding) >= PART_UPLOAD_CONCURRENCY:
+                        done, outstanding = wait(outstanding, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    for chunk in chunks:
+                        part += chunk
+                        if len(part) >= PART_SIZE:
+                            break
+
+                parts = [
+                    {'PartNumber': number, 'ETag': future.result()['ETag']}
+                    for number, future in enumerate(futures, start=1)
+                ]
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=dst_path,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+            )
+        except BaseException:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=dst_path, UploadId=upload_id)
+            raise
+
     def process_item(self, item: dict[str, str]) -> tuple[str, bool]:
         try:
             self.copy_file_to_s3(item['src'], item['dst'])
@@ -141,6 +198,11 @@ def main(
     con = sqlite3.connect(db_name)
     con.row_factory = sqlite3.Row
     cur = con.cursor()
+    # Commits do not wait for an fsync of the main database file
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=NORMAL')
+    # Rows are read while the results are written, WAL lets the reader and the writer connection work together
+    progress_con = sqlite3.connect(db_name)
     res = cur.execute("SELECT * FROM upload_progress WHERE success IS NULL")
     copier = Copier(
         s3_access_key_id=s3_access_key_id,
@@ -148,11 +210,33 @@ def main(
         bucket=bucket,
         concurrency=concurrency,
     )
-    with ThreadPoolExecutor(max_workers=concurrency) as executor:
-        for result in executor.map(copier.process_item, res.fetchall()):
-            src_url, success = result
-            cur.execute("UPDATE upload_progress SET success = ? WHERE src = ?", (success, src_url))
-            con.commit()
+    copier.collect_existing_keys()
+    pending = []
+
+    def commit_progress():
+        progress_con.executemany("UPDATE upload_progress SET success = ? WHERE src = ?", pending)
+        progress_con.commit()
+        pending.clear()
+
+    def record(futures):
+        for future in futures:
+            src_url, success = future.result()
+            pending.append((success, src_url))
+        if len(pending) >= PROGRESS_COMMIT_SIZE:
+            commit_progress()
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Rows are submitted as the workers free up instead of reading the whole backlog first
+            in_flight = set()
+            for row in res:
+                in_flight.add(executor.submit(copier.process_item, row))
+                if len(in_flight) >= concurrency * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    record(done)
+            record(as_completed(in_flight))
+    finally:
+        commit_progress()
 
 
 if __name__ == '__main__':
@@ -2,7 +2,7 @@ from datetime import datetime
 from enum import StrEnum
 from typing import Optional
 
-from sqlalchemy import Identity, String, Text, BigInteger
+from sqlalchemy import Identity, Index, String, Text, BigInteger
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy_utc import UtcDateTime, utcnow
 
@@ -20,6 +20,11 @@ class TaskStatus(StrEnum):
 
 class Task(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        # The list is paginated by (created_at, id), optionally filtered by status
+        Index('ix_tasks_created_at_id', 'created_at', 'id'),
+        Index('ix_tasks_status_created_at_id', 'status', 'created_at', 'id'),
+    )
 
     id: Mapped[int] = mapped_column(Identity(start=0, minvalue=0, cycle=True), primary_key=True, index=True)
     source_file: Mapped[str] = mapped_column(String(1024), nullable=False)
@@ -1,24 +1,43 @@
 import logging
+from functools import lru_cache
 
 from sqlalchemy.engine import make_url
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 
 from settings import Settings
 
 
-def async_engine(settings: Settings):
-    url = make_url(settings.DATABASE_URL)
+@lru_cache
+def engine_for_url(database_url: str, ssl: bool) -> AsyncEngine:
+    """
+    One engine per database, so the requests share its connection pool instead of connecting every time
+    """
+    url = make_url(database_url)
     url = url.set(drivername='postgresql+asyncpg')
-    if settings.DATABASE_SSL:
+    if ssl:
         url = url.set(query={'ssl': 'require'})
     logging.info(f'Connection to DB {url.render_as_string()}')
-    return create_async_engine(url.render_as_string(False))
+    return create_async_engine(
+        url.render_as_string(False),
+        pool_size=20,
+        max_overflow=40,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+    )
 
 
-def async_session(settings: Settings) -> AsyncSession:
-    return sessionmaker(
-        bind=async_engine(settings),
+@lru_cache
+def session_factory(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(
+        bind=engine,
         expire_on_commit=False,
         class_=AsyncSession,
-    )()
+    )
+
+
+def async_engine(settings: Settings) -> AsyncEngine:
+    return engine_for_url(settings.DATABASE_URL, settings.DATABASE_SSL)
+
+
+def async_session(settings: Settings) -> AsyncSession:
+    return session_factory(async_engine(settings))()
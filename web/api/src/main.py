@@ -7,7 +7,7 @@ from typing import Annotated
 import magic
 from fastapi import FastAPI, HTTPException, Query, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import desc, select
+from sqlalchemy import and_, desc, or_, select
 
 import schemas
 from database import Base, Task, TaskStatus, async_engine
@@ -97,20 +97,38 @@ async def list_tasks(
     statuses: Annotated[list[TaskStatus] | None, Query()] = None,
     limit: int = 100,
     skip: int = 0,
+    before_id: int | None = None,
 ) -> schemas.TaskListResponse:
     """
-    Get a list of all active encoding tasks
+    Get a list of all active encoding tasks.
+    The next page starts from the tasks created before before_id (the last task of the page),
+    it does not scan the skipped rows like skip does. An unknown before_id gives an empty list
     """
-    # Get tasks that are pending or processing
-    statement = select(Task)
+    # Only the columns of TaskResponse are loaded
+    statement = select(
+        Task.id,
+        Task.source_file,
+        Task.status,
+        Task.output_file,
+        Task.error_message,
+        Task.created_at,
+        Task.updated_at,
+    )
     if statuses:
         statement = statement.filter(Task.status.in_(statuses))
-    statement = statement.order_by(desc(Task.created_at)).offset(skip).limit(limit)
+    if before_id is not None:
+        # Keyset on (created_at, id), the cursor task is compared with its stored created_at
+        before_created_at = select(Task.created_at).filter(Task.id == before_id).scalar_subquery()
+        statement = statement.filter(or_(
+            Task.created_at < before_created_at,
+            and_(Task.created_at == before_created_at, Task.id < before_id),
+        ))
+    statement = statement.order_by(desc(Task.created_at), desc(Task.id)).offset(skip).limit(limit)
     result = await db.execute(statement)
     return schemas.TaskListResponse(
         tasks=[
             schemas.TaskResponse.model_validate(item)
-            for item in result.scalars().all()
+            for item in result.all()
         ]
     )
 
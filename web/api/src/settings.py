@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -20,6 +22,13 @@ class Settings(BaseSettings):
     REGRESSOR_PATH: str = 'model.cbm'
     CELERY_PREFETCH_MULTIPLIER: int = 1
 
+    # Split-and-stitch encoding: segment length (in seconds) and parallel encodes
+    TRANSCODE_SEGMENT_DURATION: int = 60
+    TRANSCODE_SEGMENT_WORKERS: int = 4
+    # SVT-AV1 is faster than x265 veryslow, but the regressor is trained on x265 CRF/QP
+    TRANSCODE_CODEC: Literal['libx265', 'libsvtav1'] = 'libx265'
+    TRANSCODE_SVTAV1_PRESET: int = 10
+
 
 def get_settings() -> Settings:
     return Settings()
@@ -26,6 +26,10 @@ def configure_celery(settings: Settings):
         database_url=db_string,
         task_default_queue=settings.CELERY_QUEUE_NAME,
         regressor_path=settings.REGRESSOR_PATH,
+        segment_duration=settings.TRANSCODE_SEGMENT_DURATION,
+        segment_workers=settings.TRANSCODE_SEGMENT_WORKERS,
+        codec=settings.TRANSCODE_CODEC,
+        svtav1_preset=settings.TRANSCODE_SVTAV1_PRESET,
     )
     app.conf.worker_prefetch_multiplier = settings.CELERY_PREFETCH_MULTIPLIER
     # Special for SQS
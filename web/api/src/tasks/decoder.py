@@ -1,6 +1,7 @@
 from typing import Self, Iterator
 
 import av
+import numpy as np
 
 
 class Decoder:
@@ -28,3 +29,15 @@ class Decoder:
             for packet in self.container.demux(self.video_stream)
             for frame in packet.decode()
         )
+
+
+def luma_plane(frame: av.VideoFrame) -> np.ndarray:
+    """
+    8-bit Y plane of the frame, a view of the decoded buffer without a copy
+    """
+    frame_format = frame.format
+    if frame_format.is_rgb or not frame_format.is_planar or frame_format.components[0].bits != 8:
+        frame = frame.reformat(format='gray')
+
+    plane = frame.planes[0]
+    return np.frombuffer(plane, dtype=np.uint8).reshape(plane.height, plane.line_size)[:, :plane.width]
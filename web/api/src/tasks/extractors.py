@@ -3,7 +3,9 @@ from typing import Optional
 
 import numpy as np
 from scipy import ndimage
-from skimage.feature import graycomatrix, graycoprops
+from skimage.feature import graycoprops
+
+from .kernels import GLCM_OFFSETS, glcm_counts, sobel_magnitude
 
 
 class Extractor(ABC):
@@ -46,11 +48,7 @@ class SIExtractor(Extractor):
         return 'Y'
 
     def extract(self, frame: np.ndarray) -> np.ndarray:
-        frame = frame.astype(np.int16)
-        sob_x = ndimage.sobel(frame, axis=0)
-        sob_y = ndimage.sobel(frame, axis=1)
-
-        return np.hypot(sob_x, sob_y)
+        return sobel_magnitude(frame, np.empty(frame.shape, dtype=np.float32))
 
     def name(self) -> str:
         return 'SI'
@@ -64,6 +62,8 @@ class TICalculator(Extractor):
 
     def __init__(self):
         self.prev_frame = None
+        # The difference is copied to the worker batch right away, so one buffer is reused
+        self.diff = None
 
     def depends_on(self) -> str:
         return 'Y'
@@ -73,7 +73,9 @@ class TICalculator(Extractor):
             self.prev_frame = frame
             return
 
-        ti = frame - self.prev_frame
+        if self.diff is None or self.diff.shape != frame.shape:
+            self.diff = np.empty(frame.shape, dtype=frame.dtype)
+        ti = np.subtract(frame, self.prev_frame, out=self.diff)
         self.prev_frame = frame
         return ti
 
@@ -90,13 +92,13 @@ class GLCMExtractor(Extractor):
         return 'Y'
 
     def extract(self, frame: np.ndarray) -> np.ndarray:
-        return graycomatrix(
-            frame,
-            [1],
-            [0, np.pi / 4, np.pi / 2, 3 * np.pi / 4],
-            levels=256,
-            normed=True
-        )
+        counts = glcm_counts(frame, GLCM_OFFSETS, np.empty((256, 256, len(GLCM_OFFSETS)), dtype=np.uint32))
+        # same layout and normalization as graycomatrix(frame, [1], angles, levels=256, normed=True)
+        glcm = counts[:, :, np.newaxis, :].astype(np.float64)
+        sums = glcm.sum(axis=(0, 1), keepdims=True)
+        sums[sums == 0] = 1
+        glcm /= sums
+        return glcm
 
     def name(self) -> str:
         return 'GLCM'
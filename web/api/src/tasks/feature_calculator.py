@@ -1,23 +1,26 @@
 import logging
-from concurrent.futures import (
-    FIRST_COMPLETED,
-    ThreadPoolExecutor,
-    wait,
-)
+import os
+from collections import deque
+from contextlib import ExitStack, contextmanager
 from functools import cached_property
 from graphlib import TopologicalSorter
 from itertools import chain
+from multiprocessing.shared_memory import SharedMemory
+from tempfile import NamedTemporaryFile
+from typing import Callable, Iterator, Optional
 
 import boto3
 import numpy as np
 import pandas as pd
+from billiard.pool import Pool
+from boto3.s3.transfer import TransferConfig
 from catboost import CatBoostRegressor
 from celery import Task as CeleryTask
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, update
 from sqlalchemy.orm import sessionmaker
 
 from database import Task, TaskStatus
-from .decoder import Decoder
+from .decoder import Decoder, luma_plane
 from .extractors import (
     Extractor,
     FHV13Extractor,
@@ -35,14 +38,156 @@ from .features import (
 )
 
 Processor = Extractor | FeatureCalculator
-ProcessorResult = np.ndarray | float | None
 
 
-def run_processor(processor: Processor, frame_data: np.ndarray) -> tuple[Processor, ProcessorResult]:
-    if isinstance(processor, Extractor):
-        return processor, processor.extract(frame_data)
+# Planes of a batched frame as (offset, shape) in the shared segment, None for a missing plane
+PlaneRefs = dict[Optional[str], Optional[tuple[int, tuple[int, ...]]]]
+FrameBatch = list[tuple[dict, PlaneRefs]]
+DOWNLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 2 ** 20,
+    multipart_chunksize=16 * 2 ** 20,
+    max_concurrency=16,
+    use_threads=True,
+)
+
+# Fused processors of a pool worker and the shared segments, set once by init_worker
+worker_process_frame: Callable[[dict, dict[Optional[str], np.ndarray]], dict] = None
+worker_segments: dict[str, SharedMemory] = {}
+
+
+def fuse_processors(
+    processors: dict[str, Processor],
+    execution_order: list[str],
+) -> Callable[[dict, dict[Optional[str], np.ndarray]], dict]:
+    """
+    Generates a function which calls the processors in the execution order,
+    intermediate results are local variables instead of dict items
+    """
+    namespace = {}
+    variables = {}
+    lines = ['def process_frame(item, extractors_results):']
+    for idx, name in enumerate(execution_order):
+        processor = processors[name]
+        dependency = processor.depends_on()
+        if dependency not in variables:
+            # Planes which are computed before the pool
+            variables[dependency] = f'input_{len(variables)}'
+            lines.append(f'    {variables[dependency]} = extractors_results[{dependency!r}]')
+
+        if isinstance(processor, Extractor):
+            namespace[f'processor_{idx}'] = processor.extract
+            variables[name] = f'result_{idx}'
+            lines.append(f'    result_{idx} = processor_{idx}({variables[dependency]})')
+        else:
+            namespace[f'processor_{idx}'] = processor.feed_frame
+            lines.append(f'    item[{name!r}] = processor_{idx}({variables[dependency]})')
+    lines.append('    return item')
+
+    exec('\n'.join(lines), namespace)
+    return namespace['process_frame']
+
+
+def init_worker(processors: dict[str, Processor], execution_order: list[str], segment_names: list[str]):
+    global worker_process_frame
+    worker_process_frame = fuse_processors(processors, execution_order)
+    # Segments are attached once and reused by every batch
+    for name in segment_names:
+        worker_segments[name] = SharedMemory(name)
+
+
+def process_batch(segment_name: Optional[str], batch: FrameBatch) -> list[dict]:
+    if segment_name is None:
+        # Pickled batch, the planes came with it
+        return [worker_process_frame(item, planes) for item, planes in batch]
+
+    buffer = worker_segments[segment_name].buf
+    rows = []
+    for item, planes in batch:
+        # Views of the shared segment, the planes are not pickled
+        extractors_results = {
+            name: np.ndarray(ref[1], dtype=np.uint8, buffer=buffer, offset=ref[0]) if ref else None
+            for name, ref in planes.items()
+        }
+        rows.append(worker_process_frame(item, extractors_results))
+    return rows
+
+
+def shared_memory_available() -> int:
+    """
+    Free space of the tmpfs behind POSIX shared memory. Segments are created sparse,
+    so a segment larger than the free space is only noticed by a SIGBUS on write.
+    """
+    try:
+        stat = os.statvfs('/dev/shm')
+    except OSError:
+        return 0
+    return stat.f_bavail * stat.f_frsize
+
+
+@contextmanager
+def shared_segment(size: int) -> Iterator[SharedMemory]:
+    segment = SharedMemory(create=True, size=size)
+    try:
+        yield segment
+    finally:
+        segment.close()
+        segment.unlink()
+
+
+class SharedBatch:
+    """
+    Frames of a batch written to a shared memory segment,
+    pool workers receive only offsets and shapes of the planes
+    """
+
+    def __init__(self, segment: SharedMemory):
+        self.segment = segment
+        self.offset = 0
+        self.frames: FrameBatch = []
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def append(self, item: dict, extractors_results: dict[Optional[str], Optional[np.ndarray]]) -> bool:
+        """Returns False if the planes do not fit into the rest of the segment"""
+        arrays = {id(array): array for array in extractors_results.values() if array is not None}
+        if self.offset + sum(array.nbytes for array in arrays.values()) > self.segment.size:
+            return False
+
+        refs = {}
+        for array_id, array in arrays.items():
+            np.copyto(np.ndarray(array.shape, dtype=np.uint8, buffer=self.segment.buf, offset=self.offset), array)
+            refs[array_id] = (self.offset, array.shape)
+            self.offset += array.nbytes
+
+        planes = {
+            name: refs[id(array)] if array is not None else None
+            for name, array in extractors_results.items()
+        }
+        self.frames.append((item, planes))
+        return True
+
+
+class PickledBatch:
+    """
+    Fallback when the shared memory is too small: the planes are copied and pickled with the batch
+    """
+    segment = None
 
-    return processor, processor.feed_frame(frame_data)
+    def __init__(self):
+        self.frames: FrameBatch = []
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def append(self, item: dict, extractors_results: dict[Optional[str], Optional[np.ndarray]]) -> bool:
+        # TI is written into a reused buffer, so the planes are copied before the next frame
+        planes = {
+            name: array.copy() if array is not None else None
+            for name, array in extractors_results.items()
+        }
+        self.frames.append((item, planes))
+        return True
 
 
 class FeatureCalculatorTask(CeleryTask):
@@ -50,6 +195,11 @@ class FeatureCalculatorTask(CeleryTask):
     CRFS = tuple(range(17, 31))
     QP = tuple(range(25, 41))
     PROGRESS_INTERVAL = 25
+    BATCH_SIZE = 32
+    # Batches queued to the pool, it also bounds the pool size
+    BATCHES_IN_FLIGHT = 8
+    # Shared memory of all the batch segments, the worker container must have a larger /dev/shm
+    SHARED_MEMORY_SIZE = 512 * 2 ** 20
 
     PARAMS = [
         {'parameter': 'crf', 'value': crf}
@@ -92,7 +242,7 @@ class FeatureCalculatorTask(CeleryTask):
         return regressor
 
     @classmethod
-    def analyze_file(cls, presigned_url: str) -> list[dict]:
+    def analyze_file(cls, source: str) -> list[dict]:
         single_extractors = [
             YExtractor(),
             TICalculator(),
@@ -125,15 +275,69 @@ class FeatureCalculatorTask(CeleryTask):
         ]
         processors = {
             processor.name(): processor
-            for processor in chain(single_extractors, extractors, feature_calculators)
+            for processor in chain(extractors, feature_calculators)
         }
         dependencies = {
             processor.name(): [processor.depends_on()] if processor.depends_on() else []
             for processor in chain(extractors, feature_calculators)
         }
-        pending = set()
+        # Dependencies are the same for every frame, so the order is computed once
+        execution_order = [
+            name
+            for name in TopologicalSorter(dependencies).static_order()
+            if name in processors
+        ]
+        workers = min(os.cpu_count(), cls.BATCHES_IN_FLIGHT)
+        pending = deque()
         rows = []
-        with Decoder(presigned_url) as decoder, ThreadPoolExecutor() as pool:
+        with Decoder(source) as decoder, ExitStack() as stack:
+            # One more batch is filled while the others are processed
+            slots = cls.BATCHES_IN_FLIGHT + 1
+            # Every frame puts Y and TI planes of the same size into the segment
+            codec_context = decoder.video_stream.codec_context
+            frame_size = 2 * codec_context.width * codec_context.height
+            # Segments are sized by frames, high resolutions get shorter batches instead of larger segments
+            batch_size = min(cls.BATCH_SIZE, cls.SHARED_MEMORY_SIZE // (slots * frame_size))
+            segments = []
+            if batch_size and shared_memory_available() >= slots * batch_size * frame_size:
+                try:
+                    segments = [stack.enter_context(shared_segment(batch_size * frame_size)) for _ in range(slots)]
+                except OSError as e:
+                    cls.logger.warning(f'Shared memory is not available, batches are pickled: {e}')
+                    segments = []
+            else:
+                cls.logger.warning('Not enough shared memory for the frame batches, batches are pickled')
+
+            if segments:
+                free_segments = deque(segments)
+                new_batch = SharedBatch
+            else:
+                batch_size = cls.BATCH_SIZE
+                # Slots without segments only bound the pickled batches in flight
+                free_segments = deque([None] * slots)
+                new_batch = lambda segment: PickledBatch()
+
+            pool = stack.enter_context(
+                Pool(
+                    workers,
+                    initializer=init_worker,
+                    initargs=(processors, execution_order, [segment.name for segment in segments]),
+                )
+            )
+
+            def apply(batch: SharedBatch | PickledBatch):
+                segment_name = batch.segment.name if batch.segment else None
+                pending.append((batch.segment, pool.apply_async(process_batch, (segment_name, batch.frames))))
+
+            def submit(batch: SharedBatch | PickledBatch) -> SharedBatch | PickledBatch:
+                apply(batch)
+                if not free_segments:
+                    segment, result = pending.popleft()
+                    rows.extend(result.get())
+                    free_segments.append(segment)
+                return new_batch(free_segments.popleft())
+
+            batch = new_batch(free_segments.popleft())
             duration = decoder.video_stream.duration or decoder.container.duration
             for idx, frame in enumerate(decoder):
                 if idx % cls.PROGRESS_INTERVAL == 0:
@@ -148,58 +352,31 @@ class FeatureCalculatorTask(CeleryTask):
                     'height': frame.height,
                 }
                 extractors_results = {}
-                frame_data = frame.to_ndarray()
+                # Only luma is used by the extractors, chroma planes are not copied
+                frame_data = luma_plane(frame)
 
                 extractors_results[None] = frame_data
                 for extractor in single_extractors:
                     extractors_results[extractor.name()] = extractor.extract(frame_data)
 
-                future = pool.submit(
-                    cls.process_one_frame,
-                    dependencies,
-                    extractors_results,
-                    item,
-                    processors
-                )
-                pending.add(future)
-                if len(pending) > 10:
-                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
-                    for future in done:
-                        rows.append(future.result())
+                if not batch.append(item, extractors_results):
+                    # The segment is full before batch_size frames only if the resolution grows mid-stream
+                    if batch:
+                        batch = submit(batch)
+                    if not batch.append(item, extractors_results):
+                        raise ValueError(f'Frame {frame.width}x{frame.height} does not fit into the shared segment')
 
-        for future in pending:
-            rows.append(future.result())
+                if len(batch) == batch_size:
+                    batch = submit(batch)
 
-        return rows
+            if batch:
+                apply(batch)
 
-    @staticmethod
-    def process_one_frame(
-        dependencies: dict[str, list],
-        extractors_results: dict[str, np.ndarray],
-        item,
-        processors,
-    ):
-        with ThreadPoolExecutor() as pool:
-            graph = TopologicalSorter(dependencies)
-            graph.prepare()
-            pending = set()
-            while graph.is_active():
-                ready_processors_names = graph.get_ready()
-                for name in ready_processors_names:
-                    processor = processors[name]
-                    matrix = extractors_results[processor.depends_on()]
-                    future = pool.submit(run_processor, processor, matrix)
-                    pending.add(future)
-
-                done, pending = wait(pending, return_when=FIRST_COMPLETED)
-                for future in done:
-                    calc, result = future.result()
-                    graph.done(calc.name())
-                    if isinstance(calc, Extractor):
-                        extractors_results[calc.name()] = result
-                    else:
-                        item[calc.name()] = result
-        return item
+            while pending:
+                _, result = pending.popleft()
+                rows.extend(result.get())
+
+        return rows
 
     @staticmethod
     def select_best_row(dataframe) -> dict:
@@ -218,29 +395,30 @@ class FeatureCalculatorTask(CeleryTask):
 
     def run(self, task_id: int, source_path: str) -> dict:
         with self.session_maker.begin() as session:
-            task = session.query(Task).filter_by(
-                id=task_id,
-            ).first()
+            started = session.scalar(
+                update(Task)
+                .where(Task.id == task_id, Task.status.not_in((TaskStatus.COMPLETED, TaskStatus.FAILED)))
+                .values(status=TaskStatus.PROCESSING)
+                .returning(Task.id)
+            )
 
-            if task.status in (TaskStatus.COMPLETED, TaskStatus.FAILED):
-                self.logger.error(f'Task {task.id} is finished')
-                return {'error': 'Task is finished', 'status': 'failed'}
-
-            task.status = TaskStatus.PROCESSING
-            session.commit()
+        if started is None:
+            self.logger.error(f'Task {task_id} is finished')
+            return {'error': 'Task is finished', 'status': 'failed'}
 
         source_path = source_path.lstrip('/')
-        presigned_url = self.s3_client.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': self.s3_bucket,
-                'Key': source_path,
-            },
-            ExpiresIn=3600 * 24,
-        )
         self.logger.info(f'Analyzing file {self.s3_bucket}/{source_path}')
         try:
-            data = self.analyze_file(presigned_url)
+            # Parallel ranged download is much faster than the single HTTP stream of the decoder
+            _, ext = os.path.splitext(source_path)
+            with NamedTemporaryFile(suffix=ext) as source_file:
+                self.s3_client.download_file(
+                    Bucket=self.s3_bucket,
+                    Key=source_path,
+                    Filename=source_file.name,
+                    Config=DOWNLOAD_TRANSFER_CONFIG,
+                )
+                data = self.analyze_file(source_file.name)
         except Exception as e:
             self.logger.exception(f'Error while analyzing file {self.s3_bucket}/{source_path}: {e}')
             return {'error': str(e), 'status': 'failed'}
@@ -0,0 +1,46 @@
+import numpy as np
+from numba import njit
+
+# (row, col) offsets of the GLCM angles 0, pi/4, pi/2, 3pi/4 at distance 1, the same as skimage rounds them
+GLCM_OFFSETS = np.array([(0, 1), (1, 1), (1, 0), (1, -1)], dtype=np.int64)
+
+
+@njit(nogil=True, cache=True)
+def sobel_magnitude(frame: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    hypot(sobel(axis=0), sobel(axis=1)) in a single pass,
+    borders are reflected as in scipy.ndimage
+    """
+    rows, cols = frame.shape
+    for r in range(rows):
+        top = max(r - 1, 0)
+        bottom = min(r + 1, rows - 1)
+        for c in range(cols):
+            left = max(c - 1, 0)
+            right = min(c + 1, cols - 1)
+            gx = (
+                np.int32(frame[bottom, left]) + 2 * np.int32(frame[bottom, c]) + np.int32(frame[bottom, right])
+                - np.int32(frame[top, left]) - 2 * np.int32(frame[top, c]) - np.int32(frame[top, right])
+            )
+            gy = (
+                np.int32(frame[top, right]) + 2 * np.int32(frame[r, right]) + np.int32(frame[bottom, right])
+                - np.int32(frame[top, left]) - 2 * np.int32(frame[r, left]) - np.int32(frame[bottom, left])
+            )
+            out[r, c] = np.sqrt(np.float32(gx * gx + gy * gy))
+    return out
+
+
+@njit(nogil=True, cache=True)
+def glcm_counts(frame: np.ndarray, offsets: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    Co-occurrence counts of 8-bit frame, out shape is (256, 256, len(offsets))
+    """
+    rows, cols = frame.shape
+    for a in range(offsets.shape[0]):
+        offset_row = offsets[a, 0]
+        offset_col = offsets[a, 1]
+        out[:, :, a] = 0
+        for r in range(max(0, -offset_row), min(rows, rows - offset_row)):
+            for c in range(max(0, -offset_col), min(cols, cols - offset_col)):
+                out[frame[r, c], frame[r + offset_row, c + offset_col], a] += 1
+    return out
@@ -1,21 +1,64 @@
 import logging
+import os
 import shlex
 import shutil
 import subprocess
-from functools import cached_property
-from pathlib import Path
-from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
+from tempfile import TemporaryDirectory
 from typing import Optional
 from uuid import uuid4
 
+import av
 import boto3
+from boto3.s3.transfer import TransferConfig
 from celery import Task as CeleryTask
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, update
 from sqlalchemy.orm import sessionmaker
 
 from database import Task, TaskStatus
 
 
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * 2 ** 20,
+    multipart_chunksize=16 * 2 ** 20,
+    max_concurrency=16,
+    use_threads=True,
+)
+# Constant parts of the ffmpeg commands
+GLOBAL_PARAMS = ('-y', '-hide_banner', '-loglevel', 'error')
+NETWORK_INPUT_PARAMS = (
+    '-seekable', '1',
+    '-reconnect_delay_max', '300',
+    '-multiple_requests', '1',
+    '-reconnect_on_http_error', '429,5xx',
+    '-reconnect_on_network_error', '1',
+)
+SEGMENT_PARAMS = (
+    '-map', '0:v:0',
+    '-c', 'copy',
+    '-f', 'segment',
+    '-segment_format', 'matroska',
+    '-reset_timestamps', '1',
+)
+# The moov atom can not be written after the data is streamed
+STREAM_OUTPUT_PARAMS = ('-c', 'copy', '-movflags', '+frag_keyframe+empty_moov', '-f', 'mp4', 'pipe:1')
+
+
+@lru_cache(maxsize=None)
+def find_local_executable_path(executable_name: str) -> str:
+    possible_bin_dirs = [
+        f'./{executable_name}',
+        executable_name,
+    ]
+
+    for bin_ in possible_bin_dirs:
+        if resolved_binary := shutil.which(bin_):
+            return resolved_binary
+
+    raise FileNotFoundError(f"{executable_name} not found in PATH")
+
+
 class TranscodeVideoTask(CeleryTask):
     name = 'transcode_video'
     logger = logging.getLogger('transcode_video')
@@ -43,60 +86,159 @@ class TranscodeVideoTask(CeleryTask):
 
     @cached_property
     def ffmpeg_bin(self) -> Optional[str]:
-        executable_name = 'ffmpeg'
-        possible_bin_dirs = [
-            f'./{executable_name}',
-            executable_name,
-        ]
-
-        for bin_ in possible_bin_dirs:
-            if resolved_binary := shutil.which(bin_):
-                return resolved_binary
-
-        raise FileNotFoundError(f"{executable_name} not found in PATH")
+        return find_local_executable_path('ffmpeg')
 
     @property
     def s3_bucket(self):
         return self.app.conf.get('s3_bucket')
 
+    @property
+    def segment_duration(self) -> int:
+        return self.app.conf.get('segment_duration')
+
+    @property
+    def segment_workers(self) -> int:
+        return self.app.conf.get('segment_workers')
+
+    @property
+    def segment_threads(self) -> int:
+        # Segments are encoded in parallel, each encoder gets its share of the cores
+        return max(1, (os.cpu_count() or 1) // self.segment_workers)
+
+    @property
+    def codec(self) -> str:
+        return self.app.conf.get('codec')
+
+    @property
+    def svtav1_preset(self) -> int:
+        return self.app.conf.get('svtav1_preset')
+
+    @staticmethod
+    def has_audio(input_path: str) -> bool:
+        # Only the container header is read, no ffprobe process is spawned
+        with av.open(input_path) as container:
+            return bool(container.streams.audio)
+
+    def split_video(self, input_path: str, work_dir: str) -> tuple[list[str], Optional[str]]:
+        """
+        Cut the video stream into keyframe aligned segments without re-encoding,
+        the audio is extracted as is to be muxed back after the encoding
+        """
+        audio_path = None
+        audio_params = []
+        if self.has_audio(input_path):
+            audio_path = os.path.join(work_dir, 'audio.mka')
+            audio_params = ['-map', '0:a', '-c', 'copy', audio_path]
+
+        subprocess.run(
+            [
+                self.ffmpeg_bin,
+                *GLOBAL_PARAMS,
+                *NETWORK_INPUT_PARAMS,
+                '-i', input_path,
+                *SEGMENT_PARAMS,
+                '-segment_time', str(self.segment_duration),
+                os.path.join(work_dir, 'source_%05d.mkv'),
+                *audio_params,
+            ], check=True, capture_output=True, text=True
+        )
+        segments = sorted(
+            os.path.join(work_dir, name)
+            for name in os.listdir(work_dir)
+            if name.startswith('source_')
+        )
+        return segments, audio_path
+
+    def encode_segment(self, segment_path: str, encode_params: list[str]) -> str:
+        output_path = segment_path.replace('source_', 'encoded_')
+        subprocess.run(
+            [
+                self.ffmpeg_bin,
+                *GLOBAL_PARAMS,
+                '-i', segment_path,
+                *encode_params,
+                '-f', 'matroska',
+                output_path,
+            ], check=True, capture_output=True, text=True
+        )
+        return output_path
+
+    def concat_and_upload(
+        self,
+        segments: list[str],
+        audio_path: Optional[str],
+        output_key: str,
+        work_dir: str,
+    ) -> int:
+        """
+        Stitch the segments into a fragmented mp4 which is streamed to S3
+        from ffmpeg stdout without an intermediate file, returns the uploaded size
+        """
+        list_path = os.path.join(work_dir, 'segments.txt')
+        with open(list_path, 'w') as list_file:
+            list_file.writelines(f"file '{segment}'\n" for segment in segments)
+
+        audio_params = []
+        if audio_path:
+            audio_params = ['-i', audio_path]
+
+        command = [
+            self.ffmpeg_bin,
+            *GLOBAL_PARAMS,
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', list_path,
+            *audio_params,
+            '-map', '0:v',
+            *(['-map', '1:a'] if audio_path else []),
+            *STREAM_OUTPUT_PARAMS,
+        ]
+        with (
+            open(os.path.join(work_dir, 'concat.log'), 'w+') as stderr,
+            subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, bufsize=1 << 20) as process,
+        ):
+            try:
+                self.s3_client.upload_fileobj(
+                    process.stdout,
+                    Bucket=self.s3_bucket,
+                    Key=output_key,
+                    Config=UPLOAD_TRANSFER_CONFIG,
+                )
+            except Exception:
+                process.kill()
+                raise
+
+            process.wait()
+            if process.returncode:
+                # The uploaded object is truncated
+                self.s3_client.delete_object(Bucket=self.s3_bucket, Key=output_key)
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr.read())
+
+        return self.s3_client.head_object(Bucket=self.s3_bucket, Key=output_key)['ContentLength']
+
     def encode_video(
         self,
         input_path: str,
-        output_path: str,
+        output_key: str,
         encode_params: list[str],
-    ):
-        """Encode a video using ffmpeg with the given parameters."""
+    ) -> int:
+        """
+        Encode a video using ffmpeg with the given parameters and upload it to output_key.
+        The video is split into segments which are encoded in parallel and stitched back.
+        """
         try:
             self.logger.info(f'Encoding video with {shlex.join(encode_params)}')
 
-            # Build the ffmpeg command
-            input_params = [
-                '-seekable', '1',
-                '-reconnect_delay_max', '300',
-                '-multiple_requests', '1',
-                '-reconnect_on_http_error', '429,5xx',
-                '-reconnect_on_network_error', '1',
-                '-i', input_path,
-            ]
-
-            global_params = [
-                '-codec:a', 'copy',
-                '-sn',
-                '-y',
-                '-hide_banner',
-                '-loglevel', 'error',
-                output_path
-            ]
-
-            # Run the command
-            subprocess.run(
-                [
-                    self.ffmpeg_bin,
-                    *input_params,
-                    *encode_params,
-                    *global_params
-                ], check=True, capture_output=True, text=True
-            )
+            with TemporaryDirectory() as work_dir:
+                segments, audio_path = self.split_video(input_path, work_dir)
+                self.logger.info(f'Encoding {len(segments)} segments')
+                with ThreadPoolExecutor(max_workers=self.segment_workers) as pool:
+                    encoded_segments = list(pool.map(
+                        lambda segment: self.encode_segment(segment, encode_params),
+                        segments,
+                    ))
+                return self.concat_and_upload(encoded_segments, audio_path, output_key, work_dir)
         except subprocess.CalledProcessError as e:
             logging.error(f'Error encoding video: {e.stderr}')
             raise RuntimeError(str(e)) from e
@@ -105,19 +247,18 @@ class TranscodeVideoTask(CeleryTask):
             raise RuntimeError(f'Unknown error {e}') from e
 
     def run(self, encode_params: dict, task_id: int):
+        # A single UPDATE by primary key, the task row is not loaded
         with self.session_maker.begin() as session:
-            task = session.query(Task).filter_by(
-                id=task_id,
-            ).first()
-
-            if task.status in (TaskStatus.COMPLETED, TaskStatus.FAILED):
-                logging.error(f'Task {task.id} is finished')
-                return
+            source_file = session.scalar(
+                update(Task)
+                .where(Task.id == task_id, Task.status.not_in((TaskStatus.COMPLETED, TaskStatus.FAILED)))
+                .values(status=TaskStatus.PROCESSING)
+                .returning(Task.source_file)
+            )
 
-            task.status = TaskStatus.PROCESSING
-            session.commit()
-            task_id = task.id
-            session.expunge(task)
+        if source_file is None:
+            logging.error(f'Task {task_id} is finished')
+            return
 
         encode_params = self.encode_params(encode_params)
 
@@ -126,41 +267,49 @@ class TranscodeVideoTask(CeleryTask):
             'get_object',
             Params={
                 'Bucket': self.s3_bucket,
-                'Key': task.source_file.lstrip('/'),
+                'Key': source_file.lstrip('/'),
             },
             ExpiresIn=3600 * 24,
         )
 
-        with NamedTemporaryFile(suffix='.mp4') as output_file:
-            self.logger.info(f'Encoding file {task.source_file}')
-            try:
-                self.encode_video(presigned_url, output_file.name, encode_params)
-                self.s3_client.upload_file(
-                    Filename=output_file.name,
-                    Bucket=self.s3_bucket,
-                    Key=output_key,
-                )
-            except Exception as e:
-                logging.exception('Failed processing task')
-                task.status = TaskStatus.FAILED
-                task.error_message = str(e)
-            else:
-                task.status = TaskStatus.COMPLETED
-                task.output_file = output_key
-                task.output_size = Path(output_file.name).stat().st_size
+        self.logger.info(f'Encoding file {source_file}')
+        try:
+            output_size = self.encode_video(presigned_url, output_key, encode_params)
+        except Exception as e:
+            logging.exception('Failed processing task')
+            values = {'status': TaskStatus.FAILED, 'error_message': str(e)}
+        else:
+            values = {'status': TaskStatus.COMPLETED, 'output_file': output_key, 'output_size': output_size}
 
         with self.session_maker.begin() as session:
-            session.merge(task)
-            session.commit()
+            session.execute(update(Task).where(Task.id == task_id).values(**values))
 
-        return {'task_id': task_id, 'status': task.status.value}
+        return {'task_id': task_id, 'status': values['status'].value}
 
     def encode_params(self, params: dict) -> list[str]:
         """Stub for ML model"""
-        result = [
-            '-c:v', 'libx265',
-            '-preset', 'veryslow',
-        ]
+        match self.codec:
+            case 'libsvtav1':
+                result = [
+                    '-c:v', 'libsvtav1',
+                    '-preset', str(self.svtav1_preset),
+                    '-svtav1-params', f'tune=0:film-grain=0:lp={self.segment_threads}',
+                ]
+            case _:
+                threads = self.segment_threads
+                x265_params = ':'.join([
+                    'wpp=1',
+                    'pmode=1',
+                    'pme=1',
+                    f'frame-threads={max(1, threads // 4)}',
+                    f'pools={threads}',
+                ])
+                result = [
+                    '-c:v', 'libx265',
+                    '-preset', 'veryslow',
+                    '-threads', str(threads),
+                    '-x265-params', x265_params,
+                ]
         if params['status'] == 'failed':
             result.extend(['-crf', '16'])
         elif params['status'] == 'success':
@@ -275,3 +275,24 @@ async def test_get_failed_task(client, db_session, s3_client_mock):
         'error_message': 'test error',
         'download_url': None,
     }
+
+
+async def test_list_tasks_before_id(client, generate_tasks):
+    response = await client.get('/tasks', params={'limit': 2})
+    assert response.status_code == HTTPStatus.OK, response.json()
+    first_page = response.json()['tasks']
+    assert [task['status'] for task in first_page] == ['failed', 'completed']
+
+    response = await client.get('/tasks', params={'limit': 2, 'before_id': first_page[-1]['id']})
+    assert response.status_code == HTTPStatus.OK, response.json()
+    assert [task['status'] for task in response.json()['tasks']] == ['processing', 'pending']
+
+    response = await client.get('/tasks', params={'statuses': ['pending', 'failed'], 'before_id': first_page[0]['id']})
+    assert response.status_code == HTTPStatus.OK, response.json()
+    assert [task['status'] for task in response.json()['tasks']] == ['pending']
+
+
+async def test_list_tasks_unknown_before_id(client, generate_tasks):
+    response = await client.get('/tasks', params={'before_id': max(task.id for task in generate_tasks) + 1})
+    assert response.status_code == HTTPStatus.OK, response.json()
+    assert response.json() == {'tasks': []}